@@ -0,0 +1,178 @@
+'''Remembers engine analyses, so asking for the same position again doesn't run the engine again.
+Analyses are kept in memory (the most recently used ones) and in the analysis table of analysis.db,
+a database next to games.db, so they are still there the next time the program runs.
+'''
+
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+
+
+# Database the analyses are saved in, and how many positions are kept in memory.
+CACHE_DATABASE = "analysis.db"
+MEMORY_SIZE = 4096
+
+# Seconds a write waits for another connection (e. g. another annotate.py worker) to finish writing
+# before giving up with "database is locked".
+DATABASE_TIMEOUT = 30
+
+
+def normalize_fen(fen):
+    '''Returns the FEN without the halfmove clock and the fullmove number, which don't change the analysis.
+    '''
+
+    return " ".join(fen.split()[:4])
+
+
+def at_least(limit, requested):
+    '''Returns True if a search with this limit searched at least as far as one with the requested limit.
+    None means no limit.
+    '''
+
+    return limit is None or (requested is not None and limit >= requested)
+
+
+class AnalysisCache():
+    '''Cache of analyses, keyed by engine, position, number of lines and search limits. An analysis that went
+    deeper than asked (more lines, a higher depth, more time) is returned too, cut down to the lines asked for.
+    The engine is a name (e. g. "builtin", or Stockfish's name and version), so one engine's analyses
+    aren't handed out as another's.
+    '''
+
+    def __init__(self, path=CACHE_DATABASE, memory_size=MEMORY_SIZE):
+        '''path is the SQLite database the analyses are saved in, or None to keep them in memory only.
+        The database is only opened (and created) the first time the cache is used.
+        '''
+
+        # (Engine, position) -> list of (multipv, depth_limit, time_limit, depth, lines), most recently used last.
+        self.memory = OrderedDict()
+        self.memory_size = memory_size
+
+        # Requests, and how many were answered from memory and from the database.
+        self.requests = 0
+        self.memory_hits = 0
+        self.database_hits = 0
+
+        # The engine thread and the main thread can both use the cache.
+        self.lock = threading.Lock()
+        self.path = path
+        self.db = None
+
+
+    def connect(self):
+        '''Opens the database and creates the analysis table, if that wasn't done yet. Must be called with the lock held.
+        Returns False if the cache has no database.
+        '''
+
+        if self.db is None and self.path is not None:
+            self.db = sqlite3.connect(self.path, timeout=DATABASE_TIMEOUT, check_same_thread=False)
+
+            # Tables from before analyses were keyed by engine can't tell which engine made them, so they're dropped.
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(analysis)")]
+            if columns and "engine" not in columns:
+                self.db.execute("DROP TABLE analysis")
+            self.db.execute("CREATE TABLE IF NOT EXISTS analysis (engine TEXT NOT NULL, fen TEXT NOT NULL, multipv INT NOT NULL, "
+                            "depth_limit INT, time_limit REAL, depth INT NOT NULL, lines TEXT NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS analysis_engine_fen ON analysis (engine, fen)")
+            self.db.commit()
+        return self.db is not None
+
+
+    def covers(self, entry, multipv, depth_limit, time_limit):
+        '''Returns True if the analysis in entry answers a request with these parameters: it has enough lines, and
+        either reached the requested depth or was given at least the same limits.
+        '''
+
+        entry_multipv, entry_depth_limit, entry_time_limit, depth, lines = entry
+        if entry_multipv < multipv:
+            return False
+        if depth_limit is not None and depth >= depth_limit:
+            return True
+        return at_least(entry_depth_limit, depth_limit) and at_least(entry_time_limit, time_limit)
+
+
+    def get(self, engine, fen, multipv=1, depth_limit=None, time_limit=None):
+        '''Returns the analysis of the position by the engine (as returned by engine.analyze_position) if one
+        that answers the request was saved, or None.
+        '''
+
+        fen = normalize_fen(fen)
+        with self.lock:
+            self.requests += 1
+
+            # Looks in memory first.
+            entries = self.memory.get((engine, fen))
+            if entries is not None:
+                self.memory.move_to_end((engine, fen))
+                for entry in entries:
+                    if self.covers(entry, multipv, depth_limit, time_limit):
+                        self.memory_hits += 1
+                        return entry[4][:multipv]
+            if not self.connect():
+                return None
+
+            # Then in the database, and keeps what it finds in memory.
+            for row in self.db.execute("SELECT multipv, depth_limit, time_limit, depth, lines FROM analysis WHERE engine = ? AND fen = ? "
+                                       "ORDER BY depth DESC", (engine, fen)):
+                entry = row[:4] + (json.loads(row[4]),)
+                if self.covers(entry, multipv, depth_limit, time_limit):
+                    self.database_hits += 1
+                    self.remember((engine, fen), entry)
+                    return entry[4][:multipv]
+            return None
+
+
+    def put(self, engine, fen, multipv, depth_limit, time_limit, depth, lines):
+        '''Saves the engine's analysis of a position. depth is the depth the engine actually reached.
+        '''
+
+        fen = normalize_fen(fen)
+        entry = (multipv, depth_limit, time_limit, depth, lines)
+        with self.lock:
+            self.remember((engine, fen), entry)
+            if self.connect():
+                self.db.execute("DELETE FROM analysis WHERE engine = ? AND fen = ? AND multipv = ? AND depth_limit IS ? AND time_limit IS ?",
+                                (engine, fen, multipv, depth_limit, time_limit))
+                self.db.execute("INSERT INTO analysis (engine, fen, multipv, depth_limit, time_limit, depth, lines) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (engine, fen, multipv, depth_limit, time_limit, depth, json.dumps(lines)))
+                self.db.commit()
+
+
+    def remember(self, key, entry):
+        '''Keeps an analysis in memory under its (engine, position) key, forgetting the least recently used
+        position if memory is full. Entries that reached further come first.
+        '''
+
+        entries = [other for other in self.memory.pop(key, []) if other[:3] != entry[:3]]
+        entries.append(entry)
+        entries.sort(key=lambda other: other[3], reverse=True)
+        self.memory[key] = entries
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+
+    def hit_ratio(self):
+        '''Returns the fraction of requests answered from the cache.
+        '''
+
+        return (self.memory_hits + self.database_hits) / self.requests if self.requests else 0.0
+
+
+    def report(self):
+        '''Returns a line with the cache's hit ratio.
+        '''
+
+        return ("Analysis cache: " + str(self.memory_hits + self.database_hits) + "/" + str(self.requests) + " hits (" +
+                "%.0f" % (100 * self.hit_ratio()) + "%; " + str(self.memory_hits) + " from memory, " +
+                str(self.database_hits) + " from the database)")
+
+
+    def close(self):
+        '''Closes the database (it's opened again if the cache is used afterwards).
+        '''
+
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
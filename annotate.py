@@ -0,0 +1,204 @@
+'''Annotates every game in games.db: replays it, analyses each position with the engine and saves, for every
+move, the evaluation before and after it, the engine's best move and whether it was an inaccuracy,
+a mistake or a blunder. The analysis runs in several worker processes, each with its own engine
+(Stockfish, or the built-in engine if Stockfish can't be started).
+
+Annotations go in the annotations table of analysis.db (next to the analyses the engine made), one row per
+game and ply, so games.db is only read. Plies that are already there are skipped, so an interrupted run
+carries on where it stopped.
+
+Usage:
+    python annotate.py                          # Every game, depth 12 or half a second per position.
+    python annotate.py --game 2 --depth 16      # Only game 2, deeper.
+    python annotate.py --workers 4 --batch 500  # 4 worker processes, committing every 500 plies.
+'''
+
+from analysis_cache import AnalysisCache, CACHE_DATABASE, DATABASE_TIMEOUT
+import argparse
+import chess
+from concurrent.futures import ProcessPoolExecutor
+import engine
+from pgnparser import pgn_parser
+import sqlite3
+import time
+
+
+DATABASE = "games.db"
+
+# Default limits of each position's analysis, and number of plies written per transaction.
+DEPTH = 12
+TIME = 0.5
+BATCH_SIZE = 200
+
+# A forced mate counts as this many centipawns (less one per move to the mate), like python-chess's Score.score.
+MATE_VALUE = 10000
+
+# Evaluations are capped at this many centipawns when working out how much a move lost,
+# so going from a won position to a slightly less won one doesn't count as a blunder.
+EVAL_CAP = 1000
+
+# Centipawns a move has to lose to be an inaccuracy, a mistake or a blunder. Checked in order.
+CLASSIFICATIONS = [(300, "blunder"), (100, "mistake"), (50, "inaccuracy")]
+
+
+def create_table(db):
+    '''Creates the annotations table if it isn't there yet. Scores are in centipawns from white's point of view,
+    and loss is what the move cost the player who made it.
+    '''
+
+    db.execute("CREATE TABLE IF NOT EXISTS annotations (game_id INTEGER NOT NULL, ply INTEGER NOT NULL, fen TEXT NOT NULL, "
+               "move TEXT NOT NULL, best_move TEXT, score_before INT NOT NULL, score_after INT NOT NULL, "
+               "loss INT NOT NULL, classification TEXT, PRIMARY KEY(game_id, ply))")
+    db.commit()
+
+
+def positions(pgn):
+    '''Replays a game and returns the list of its moves in UCI notation and the list of
+    the FENs before each move and after the last one.
+    '''
+
+    moves = pgn_parser(pgn)
+    board = chess.Board()
+    fens = [board.fen()]
+    for move in moves:
+        board.push_uci(move)
+        fens.append(board.fen())
+    return moves, fens
+
+
+def start_worker():
+    '''Runs in each worker process when it starts. Gives the worker its own analysis cache (and so its own
+    connection to analysis.db), since an SQLite connection copied from the parent process can't be shared.
+    '''
+
+    engine.cache = AnalysisCache()
+
+
+def analyse(task):
+    '''Analyses one position in a worker process. Returns its score in centipawns from white's
+    point of view and the engine's best move (None if the game is over).
+    '''
+
+    fen, depth_limit, time_limit = task
+    board = chess.Board(fen)
+    if board.is_checkmate():
+        return (-MATE_VALUE if board.turn == chess.WHITE else MATE_VALUE), None
+    if board.is_stalemate() or board.is_insufficient_material():
+        return 0, None
+
+    line = engine.analyze_position(fen, 1, depth_limit, time_limit)[0]
+    if line["mate_score"] is not None:
+        mate = line["mate_score"]
+        score = MATE_VALUE - mate if mate > 0 else -MATE_VALUE - mate
+    else:
+        score = line["centipawn_score"]
+    return score, line["pv"][0] if line["pv"] else None
+
+
+def classify(loss):
+    '''Returns "blunder", "mistake" or "inaccuracy" for a move that lost that many centipawns, or None.
+    '''
+
+    for threshold, name in CLASSIFICATIONS:
+        if loss >= threshold:
+            return name
+    return None
+
+
+def annotate_game(db, executor, game_id, pgn, depth_limit, time_limit):
+    '''Analyses the plies of a game that aren't annotated yet and returns their rows, and
+    the number of positions analysed.
+    '''
+
+    moves, fens = positions(pgn)
+    done = {row[0] for row in db.execute("SELECT ply FROM annotations WHERE game_id = ?", (game_id,))}
+    plies = [ply for ply in range(1, len(moves) + 1) if ply not in done]
+
+    # Each ply needs the positions before and after its move; neighbouring plies share them.
+    needed = sorted({index for ply in plies for index in (ply - 1, ply)})
+    results = dict(zip(needed, executor.map(analyse, [(fens[index], depth_limit, time_limit) for index in needed])))
+
+    rows = []
+    for ply in plies:
+        score_before, best_move = results[ply - 1]
+        score_after, _ = results[ply]
+        capped_before = max(-EVAL_CAP, min(EVAL_CAP, score_before))
+        capped_after = max(-EVAL_CAP, min(EVAL_CAP, score_after))
+
+        # White moves on odd plies, black on even ones.
+        loss = capped_before - capped_after if ply % 2 == 1 else capped_after - capped_before
+        loss = max(0, loss) if moves[ply - 1] != best_move else 0
+        rows.append((game_id, ply, fens[ply - 1], moves[ply - 1], best_move, score_before, score_after, loss, classify(loss)))
+    return rows, len(needed)
+
+
+def annotate(database=DATABASE, game_ids=None, depth_limit=DEPTH, time_limit=TIME, workers=None, batch_size=BATCH_SIZE,
+             output=CACHE_DATABASE):
+    '''Annotates the games in database (every game if game_ids is None) with workers processes (one per CPU if None),
+    saving the annotations in output and committing every batch_size plies. Prints the progress and the positions
+    analysed per second.
+    '''
+
+    games_db = sqlite3.connect(database)
+    games = games_db.execute("SELECT id, pgn FROM games ORDER BY id").fetchall()
+    games_db.close()
+    if game_ids is not None:
+        games = [(game_id, pgn) for game_id, pgn in games if game_id in game_ids]
+
+    # The workers write their analyses to the same database, so writes may have to wait for each other.
+    db = sqlite3.connect(output, timeout=DATABASE_TIMEOUT)
+    create_table(db)
+
+    pending = []
+    total_positions = 0
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=start_worker) as executor:
+            for game_id, pgn in games:
+                game_start = time.perf_counter()
+                rows, analysed = annotate_game(db, executor, game_id, pgn, depth_limit, time_limit)
+                total_positions += analysed
+                elapsed = time.perf_counter() - game_start
+                print("Game " + str(game_id) + ": " + str(len(rows)) + " plies, " + str(analysed) + " positions in " +
+                      "%.3f" % elapsed + "s (" + "%.1f" % (analysed / elapsed if elapsed > 0 else 0) + " positions/s)")
+
+                # Writes the rows in batches, each in one transaction.
+                pending.extend(rows)
+                while len(pending) >= batch_size:
+                    write_rows(db, pending[:batch_size])
+                    pending = pending[batch_size:]
+    finally:
+        # Rows of finished games are kept even if the run is interrupted (e. g. with Ctrl-C).
+        write_rows(db, pending)
+        db.close()
+
+    elapsed = time.perf_counter() - start
+    print("Total: " + str(total_positions) + " positions in " + "%.3f" % elapsed + "s (" +
+          "%.1f" % (total_positions / elapsed if elapsed > 0 else 0) + " positions/s)")
+
+
+def write_rows(db, rows):
+    '''Saves annotation rows in a single transaction.
+    '''
+
+    with db:
+        db.executemany("INSERT OR REPLACE INTO annotations (game_id, ply, fen, move, best_move, score_before, score_after, "
+                       "loss, classification) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotates the games in the database with engine evaluations.")
+    parser.add_argument("--database", default=DATABASE, help="SQLite database with the games table")
+    parser.add_argument("--output", default=CACHE_DATABASE, help="SQLite database the annotations are saved in")
+    parser.add_argument("--game", type=int, action="append", help="id of a game to annotate (can be repeated)")
+    parser.add_argument("--depth", type=int, default=DEPTH, help="maximum depth of each analysis")
+    parser.add_argument("--time", type=float, default=TIME, help="time limit of each analysis in seconds")
+    parser.add_argument("--workers", type=int, help="number of worker processes")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="plies written per transaction")
+    args = parser.parse_args()
+
+    annotate(args.database, args.game, args.depth, args.time, args.workers, args.batch, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+'''Precomputed attack and ray tables used by the move generator in gamestate.py.
+Everything here is computed once, when the module is first imported.
+Source: https://www.chessprogramming.org/Bitboards
+
+Every square on the board has an index from 0 to 63, given by row * 8 + col.
+A bitboard is an int in which bit n is set when square n is occupied, so
+index 0 is a8 (top left) and index 63 is h1 (bottom right).
+'''
+
+# The eight directions as (row, col) steps. Moving "up" the board (towards rank 8) lowers the row.
+DIRECTIONS = {"N": (-1, 0), "S": (1, 0), "E": (0, 1), "W": (0, -1),
+              "NE": (-1, 1), "NW": (-1, -1), "SE": (1, 1), "SW": (1, -1)}
+
+
+def ray_squares(sq, dr, dc):
+    '''Returns the list of squares from sq (exclusive) to the edge of the board
+    in the direction (dr, dc), nearest first.
+    '''
+
+    r, c = sq // 8 + dr, sq % 8 + dc
+    squares = []
+    while 0 <= r < 8 and 0 <= c < 8:
+        squares.append(r * 8 + c)
+        r, c = r + dr, c + dc
+    return squares
+
+
+def offset_mask(sq, offsets):
+    '''Returns a bitboard with the squares reached by jumping from sq by each offset.
+    '''
+
+    r, c = sq // 8, sq % 8
+    mask = 0
+    for dr, dc in offsets:
+        if 0 <= r + dr < 8 and 0 <= c + dc < 8:
+            mask |= 1 << ((r + dr) * 8 + c + dc)
+    return mask
+
+
+def to_mask(squares):
+    '''Returns a bitboard with the given squares set.
+    '''
+
+    mask = 0
+    for sq in squares:
+        mask |= 1 << sq
+    return mask
+
+
+# The squares along each direction from every square, as sequences (nearest first) and as bitboards.
+RAY_SQUARES = {name: [ray_squares(sq, dr, dc) for sq in range(64)] for name, (dr, dc) in DIRECTIONS.items()}
+RAYS = {name: [to_mask(squares) for squares in RAY_SQUARES[name]] for name in DIRECTIONS}
+
+# Precomputed attack masks for the leaping pieces.
+KNIGHT_ATTACKS = [offset_mask(sq, [(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)])
+                  for sq in range(64)]
+KING_ATTACKS = [offset_mask(sq, list(DIRECTIONS.values())) for sq in range(64)]
+
+# Squares attacked by a pawn of the given colour standing on each square.
+PAWN_ATTACKS = {"w": [offset_mask(sq, [(-1, -1), (-1, 1)]) for sq in range(64)],
+                "b": [offset_mask(sq, [(1, -1), (1, 1)]) for sq in range(64)]}
+
+# Squares a rook or a bishop would attack from each square on an empty board.
+ROOK_MASKS = [RAYS["N"][sq] | RAYS["S"][sq] | RAYS["E"][sq] | RAYS["W"][sq] for sq in range(64)]
+BISHOP_MASKS = [RAYS["NE"][sq] | RAYS["NW"][sq] | RAYS["SE"][sq] | RAYS["SW"][sq] for sq in range(64)]
+
+
+def between_masks():
+    '''Returns a 64x64 table with the squares strictly between two squares that share
+    a rank, file or diagonal. Squares that are not aligned have an empty mask.
+    '''
+
+    between = [[0] * 64 for _ in range(64)]
+    for sq in range(64):
+        for name in DIRECTIONS:
+            mask = 0
+            for target in RAY_SQUARES[name][sq]:
+                between[sq][target] = mask
+                mask |= 1 << target
+    return between
+
+
+BETWEEN = between_masks()
+
+# Used by the move generator when no piece has to block or capture a checker.
+ALL_SQUARES = (1 << 64) - 1
+
+# South and east rays (and the south-west and south-east diagonals) run towards higher
+# square indices, so the nearest blocker is the lowest set bit; the others run towards
+# lower indices, so the nearest blocker is the highest set bit. Cutting the ray at the
+# blocker leaves the blocker itself in, since it may be a capture.
+S, E, N, W = RAYS["S"], RAYS["E"], RAYS["N"], RAYS["W"]
+SE, SW, NE, NW = RAYS["SE"], RAYS["SW"], RAYS["NE"], RAYS["NW"]
+
+
+def rook_attacks(sq, occupied):
+    '''Returns the squares a rook on sq attacks, given the occupied squares.
+    '''
+
+    attacks = 0
+    ray = S[sq]
+    blockers = ray & occupied
+    if blockers:
+        ray ^= S[(blockers & -blockers).bit_length() - 1]
+    attacks |= ray
+    ray = E[sq]
+    blockers = ray & occupied
+    if blockers:
+        ray ^= E[(blockers & -blockers).bit_length() - 1]
+    attacks |= ray
+    ray = N[sq]
+    blockers = ray & occupied
+    if blockers:
+        ray ^= N[blockers.bit_length() - 1]
+    attacks |= ray
+    ray = W[sq]
+    blockers = ray & occupied
+    if blockers:
+        ray ^= W[blockers.bit_length() - 1]
+    return attacks | ray
+
+
+def bishop_attacks(sq, occupied):
+    '''Returns the squares a bishop on sq attacks, given the occupied squares.
+    '''
+
+    attacks = 0
+    ray = SE[sq]
+    blockers = ray & occupied
+    if blockers:
+        ray ^= SE[(blockers & -blockers).bit_length() - 1]
+    attacks |= ray
+    ray = SW[sq]
+    blockers = ray & occupied
+    if blockers:
+        ray ^= SW[(blockers & -blockers).bit_length() - 1]
+    attacks |= ray
+    ray = NE[sq]
+    blockers = ray & occupied
+    if blockers:
+        ray ^= NE[blockers.bit_length() - 1]
+    attacks |= ray
+    ray = NW[sq]
+    blockers = ray & occupied
+    if blockers:
+        ray ^= NW[blockers.bit_length() - 1]
+    return attacks | ray
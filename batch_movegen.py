@@ -0,0 +1,364 @@
+'''Vectorised move counting, attack maps and check detection over many positions at once, with NumPy.
+Each position is a row of twelve uint64 bitboards (in gamestate.PIECES order), so every operation
+below (shifts, masks, fills) runs on all the positions of the batch at the same time.
+Source: https://www.chessprogramming.org/Dumb7Fill and https://www.chessprogramming.org/General_Setwise_Operations
+
+Usage:
+    batch = PositionBatch.from_fens(fens)
+    counts = legal_move_counts(batch)
+'''
+
+import numpy as np
+from fen_parser import FenParser
+from gamestate import *
+
+
+U64 = np.uint64
+ZERO = U64(0)
+ONE = U64(1)
+ALL = U64((1 << 64) - 1)
+
+# Square index is row * 8 + col, as in gamestate.py: bit 0 is a8 and bit 63 is h1.
+FILE_A = U64(sum(1 << (r * 8) for r in range(8)))
+FILE_B = U64(sum(1 << (r * 8 + 1) for r in range(8)))
+FILE_G = U64(sum(1 << (r * 8 + 6) for r in range(8)))
+FILE_H = U64(sum(1 << (r * 8 + 7) for r in range(8)))
+ROWS = [U64(0xFF << (r * 8)) for r in range(8)]
+
+# Directions as (row, col) steps, with the files a shift in that direction must not wrap onto.
+NOT_WRAPPED = {-2: ~(FILE_G | FILE_H), -1: ~FILE_H, 0: ALL, 1: ~FILE_A, 2: ~(FILE_A | FILE_B)}
+ROOK_DIRECTIONS = [(-1, 0), (1, 0), (0, 1), (0, -1)]
+BISHOP_DIRECTIONS = [(-1, 1), (-1, -1), (1, 1), (1, -1)]
+KNIGHT_OFFSETS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)]
+
+# Index of each piece's bitboard in a position's row.
+INDEX = {piece: i for i, piece in enumerate(PIECES)}
+
+
+def shift(bb, dr, dc):
+    '''Moves every bit of bb by dr rows and dc columns, dropping the bits that leave the board.
+    '''
+
+    amount = dr * 8 + dc
+    if amount > 0:
+        bb = bb << U64(amount)
+    else:
+        bb = bb >> U64(-amount)
+    return bb & NOT_WRAPPED[dc]
+
+
+def slide(bb, empty, dr, dc):
+    '''Returns the squares attacked by sliders on bb in the direction (dr, dc): each ray
+    continues through empty squares and stops at (and includes) the first occupied one.
+    '''
+
+    flood = bb.copy()
+    for _ in range(6):
+        bb = shift(bb, dr, dc) & empty
+        flood |= bb
+    return shift(flood, dr, dc)
+
+
+def popcount(bb):
+    '''Counts the set bits of each bitboard.
+    '''
+
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bb).astype(np.int64)
+
+    # Older NumPy versions: SWAR popcount.
+    bb = bb - ((bb >> U64(1)) & U64(0x5555555555555555))
+    bb = (bb & U64(0x3333333333333333)) + ((bb >> U64(2)) & U64(0x3333333333333333))
+    bb = (bb + (bb >> U64(4))) & U64(0x0F0F0F0F0F0F0F0F)
+    return ((bb * U64(0x0101010101010101)) >> U64(56)).astype(np.int64)
+
+
+def lowest_bit(bb):
+    '''Returns the lowest set bit of each bitboard (0 where the bitboard is empty).
+    '''
+
+    return bb & (~bb + ONE)
+
+
+class PositionBatch():
+    '''A batch of positions: one row of twelve bitboards per position, plus the side to move,
+    the castling rights (gamestate.castling_index bits) and the en passant square (-1 if none).
+    '''
+
+    def __init__(self, pieces, white, castling=None, ep=None):
+        self.pieces = np.asarray(pieces, dtype=np.uint64).reshape(-1, len(PIECES))
+        self.white = np.asarray(white, dtype=bool).reshape(-1)
+        n = len(self.pieces)
+        self.castling = np.zeros(n, dtype=np.uint8) if castling is None else np.asarray(castling, dtype=np.uint8)
+        self.ep = np.full(n, -1, dtype=np.int64) if ep is None else np.asarray(ep, dtype=np.int64)
+
+
+    def __len__(self):
+        return len(self.pieces)
+
+
+    @classmethod
+    def from_planes(cls, planes, white, castling=None, ep=None):
+        '''Builds the batch from boolean board planes of shape (N, 12, 8, 8), one plane
+        per piece in gamestate.PIECES order, laid out like GameState.board.
+        '''
+
+        planes = np.asarray(planes, dtype=bool).reshape(-1, len(PIECES), 64)
+        bits = ONE << np.arange(64, dtype=np.uint64)
+        pieces = np.bitwise_or.reduce(np.where(planes, bits, ZERO), axis=2)
+        return cls(pieces, white, castling, ep)
+
+
+    @classmethod
+    def from_boards(cls, boards, white, castling=None, ep=None):
+        '''Builds the batch from 2D list boards like GameState.board or FenParser.parse's output.
+        '''
+
+        squares = np.asarray(boards, dtype="<U2").reshape(-1, 1, 8, 8)
+        planes = squares == np.asarray(PIECES).reshape(1, -1, 1, 1)
+        return cls.from_planes(planes, white, castling, ep)
+
+
+    @classmethod
+    def from_fens(cls, fens):
+        '''Builds the batch from FEN strings, read with FenParser.
+        '''
+
+        boards, white, castling, ep = [], [], [], []
+        for fen in fens:
+            fp = FenParser(fen)
+            boards.append(fp.parse())
+            white.append(fp.turn() == "w")
+            castle = fp.castle()
+            castling.append(castling_index(CastleRights("K" in castle, "k" in castle, "Q" in castle, "q" in castle)))
+            square = fp.en_passant()
+            ep.append(-1 if square == "-" else ranks_to_rows[square[1]] * 8 + files_to_cols[square[0]])
+        return cls.from_boards(boards, white, castling, ep)
+
+
+    @classmethod
+    def from_gamestates(cls, states):
+        '''Builds the batch from GameState objects, copying their bitboards.
+        '''
+
+        pieces = [[gs.pieces[piece] for piece in PIECES] for gs in states]
+        white = [gs.w_to_move for gs in states]
+        castling = [gs.castling_rights for gs in states]
+        ep = [gs.ep_possible[0] * 8 + gs.ep_possible[1] if gs.ep_possible else -1 for gs in states]
+        return cls(pieces, white, castling, ep)
+
+
+    def side(self, color_is_white):
+        '''Returns a dict from piece letter ("P", "N", ...) to the bitboards of that piece, for the
+        side given by the color_is_white boolean array (white where True, black where False).
+        '''
+
+        return {letter: np.where(color_is_white, self.pieces[:, INDEX["w" + letter]], self.pieces[:, INDEX["b" + letter]])
+                for letter in "PNBRQK"}
+
+
+def occupancy(side):
+    return side["P"] | side["N"] | side["B"] | side["R"] | side["Q"] | side["K"]
+
+
+def pawn_attacks(pawns, white):
+    '''Squares attacked by the pawns, which move up the board for white and down for black.
+    '''
+
+    up = shift(pawns, -1, -1) | shift(pawns, -1, 1)
+    down = shift(pawns, 1, -1) | shift(pawns, 1, 1)
+    return np.where(white, up, down)
+
+
+def knight_attacks(knights):
+    attacks = np.zeros_like(knights)
+    for dr, dc in KNIGHT_OFFSETS:
+        attacks |= shift(knights, dr, dc)
+    return attacks
+
+
+def king_attacks(kings):
+    attacks = np.zeros_like(kings)
+    for dr, dc in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+        attacks |= shift(kings, dr, dc)
+    return attacks
+
+
+def side_attacks(side, white, occupied):
+    '''Returns every square attacked by one side, given the occupied squares.
+    '''
+
+    empty = ~occupied
+    attacks = pawn_attacks(side["P"], white) | knight_attacks(side["N"]) | king_attacks(side["K"])
+    rooks = side["R"] | side["Q"]
+    bishops = side["B"] | side["Q"]
+    for dr, dc in ROOK_DIRECTIONS:
+        attacks |= slide(rooks, empty, dr, dc)
+    for dr, dc in BISHOP_DIRECTIONS:
+        attacks |= slide(bishops, empty, dr, dc)
+    return attacks
+
+
+def attack_maps(batch):
+    '''Returns two uint64 arrays with the squares attacked by white and by black in each position.
+    '''
+
+    ones = np.ones(len(batch), dtype=bool)
+    white, black = batch.side(ones), batch.side(~ones)
+    occupied = occupancy(white) | occupancy(black)
+    return side_attacks(white, ones, occupied), side_attacks(black, ~ones, occupied)
+
+
+def in_check(batch):
+    '''Returns a boolean array: True where the side to move is in check.
+    '''
+
+    own, enemy = batch.side(batch.white), batch.side(~batch.white)
+    occupied = occupancy(own) | occupancy(enemy)
+    return (side_attacks(enemy, ~batch.white, occupied) & own["K"]) != ZERO
+
+
+def piece_targets(letter, bb, white, empty, enemies):
+    '''Returns the squares a single piece (one bit per position in bb) can move to, before
+    looking at checks and pins. For pawns, it also returns the promotion squares among them.
+    '''
+
+    if letter == "P":
+        one = np.where(white, shift(bb, -1, 0), shift(bb, 1, 0)) & empty
+        double_row = np.where(white, ROWS[5], ROWS[2])
+        two = np.where(white, shift(one & double_row, -1, 0), shift(one & double_row, 1, 0)) & empty
+        return one | two | pawn_attacks(bb, white) & enemies
+    if letter == "N":
+        return knight_attacks(bb)
+    if letter == "K":
+        return king_attacks(bb)
+    targets = np.zeros_like(bb)
+    if letter in "RQ":
+        for dr, dc in ROOK_DIRECTIONS:
+            targets |= slide(bb, empty, dr, dc)
+    if letter in "BQ":
+        for dr, dc in BISHOP_DIRECTIONS:
+            targets |= slide(bb, empty, dr, dc)
+    return targets
+
+
+def count_targets(letter, targets, white):
+    '''Counts the moves to the target squares. A pawn reaching the last rank counts four times
+    (one move per promotion piece), like in GameState.
+    '''
+
+    if letter != "P":
+        return popcount(targets)
+    last_row = np.where(white, ROWS[0], ROWS[7])
+    return popcount(targets & ~last_row) + 4 * popcount(targets & last_row)
+
+
+def ep_targets(batch, pawn, white, enemies_pawns):
+    '''Returns the en passant square where the single pawn can capture en passant, along
+    with the square of the pawn it would capture.
+    '''
+
+    has_ep = batch.ep >= 0
+    ep_bb = np.where(has_ep, ONE << np.where(has_ep, batch.ep, 0).astype(np.uint64), ZERO)
+    target = pawn_attacks(pawn, white) & ep_bb
+    captured = np.where(white, shift(target, 1, 0), shift(target, -1, 0)) & enemies_pawns
+    return np.where(captured != ZERO, target, ZERO), captured
+
+
+def pseudo_legal_move_counts(batch):
+    '''Counts the possible moves in each position, the same way GameState.possible_moves does:
+    checks and pins are ignored, and castling isn't included.
+    '''
+
+    white = batch.white
+    own, enemy = batch.side(white), batch.side(~white)
+    own_occupancy, enemies = occupancy(own), occupancy(enemy)
+    empty = ~(own_occupancy | enemies)
+    counts = np.zeros(len(batch), dtype=np.int64)
+    for letter in "PNBRQK":
+        bb = own[letter].copy()
+        while bb.any():
+            piece = lowest_bit(bb)
+            bb ^= piece
+            targets = piece_targets(letter, piece, white, empty, enemies) & ~own_occupancy
+            counts += count_targets(letter, targets, white)
+            if letter == "P":
+                counts += popcount(ep_targets(batch, piece, white, enemy["P"])[0])
+    return counts
+
+
+def legal_move_counts(batch):
+    '''Counts the valid moves in each position, the same way GameState.legal_moves finds them:
+    the king avoids attacked squares, other pieces must capture or block a single checker
+    (and can't move in double check), and pinned pieces stay on the line of their pin.
+    '''
+
+    white = batch.white
+    own, enemy = batch.side(white), batch.side(~white)
+    own_occupancy, enemies = occupancy(own), occupancy(enemy)
+    occupied = own_occupancy | enemies
+    empty = ~occupied
+    king = own["K"]
+    n = len(batch)
+
+    # Checkers, the check evasion mask, and the pins, one ray direction at a time. Only one
+    # piece can be pinned along each direction, so each direction has a single pin line.
+    checkers = (knight_attacks(king) & enemy["N"]) | (pawn_attacks(king, white) & enemy["P"])
+    evasion = checkers.copy()
+    pins = []
+    for directions, sliders in ((ROOK_DIRECTIONS, enemy["R"] | enemy["Q"]),
+                                (BISHOP_DIRECTIONS, enemy["B"] | enemy["Q"])):
+        for dr, dc in directions:
+            ray = slide(king, empty, dr, dc)
+            checker = ray & sliders
+            checkers |= checker
+            evasion |= np.where(checker != ZERO, ray, ZERO)
+            blocker = ray & own_occupancy
+            beyond = slide(blocker, empty, dr, dc)
+            pinned = np.where((beyond & sliders) != ZERO, blocker, ZERO)
+            pins.append((pinned, ray | beyond))
+    num_checkers = popcount(checkers)
+    evasion = np.where(num_checkers == 0, ALL, np.where(num_checkers == 1, evasion, ZERO))
+
+    # King moves: squares not attacked once the king is lifted off the board.
+    danger = side_attacks(enemy, ~white, occupied ^ king)
+    counts = popcount(king_attacks(king) & ~own_occupancy & ~danger)
+
+    for letter in "PNBRQ":
+        bb = own[letter].copy()
+        while bb.any():
+            piece = lowest_bit(bb)
+            bb ^= piece
+            allowed = evasion & ~own_occupancy
+            for pinned, line in pins:
+                allowed = np.where((piece & pinned) != ZERO, allowed & line, allowed)
+            targets = piece_targets(letter, piece, white, empty, enemies) & allowed
+            counts += count_targets(letter, targets, white)
+
+            # En passant: it must resolve any check, and taking both pawns off the rank
+            # must not expose the king to a slider.
+            if letter == "P":
+                target, captured = ep_targets(batch, piece, white, enemy["P"])
+                after = occupied ^ piece ^ captured | target
+                exposed = np.zeros(n, dtype=np.uint64)
+                for dr, dc in ROOK_DIRECTIONS:
+                    exposed |= slide(king, ~after, dr, dc) & (enemy["R"] | enemy["Q"])
+                for dr, dc in BISHOP_DIRECTIONS:
+                    exposed |= slide(king, ~after, dr, dc) & (enemy["B"] | enemy["Q"])
+                legal = (target != ZERO) & ((evasion & (target | captured)) != ZERO) & (exposed == ZERO)
+                counts += legal.astype(np.int64)
+
+    # Castling: rights, king on its square, empty path, and no check on the squares the king crosses.
+    home = np.where(white, U64(1 << 60), U64(1 << 4))
+    can_castle = (num_checkers == 0) & ((king & home) != ZERO)
+    kingside_bit = np.where(white, 1, 4)
+    queenside_bit = np.where(white, 2, 8)
+    base = np.where(white, U64(60), U64(4))
+    kingside_path = (U64(0b11) << (base + ONE))
+    queenside_path = (U64(0b111) << (base - U64(3)))
+    queenside_crossed = (U64(0b11) << (base - U64(2)))
+    kingside = (can_castle & ((batch.castling & kingside_bit) != 0) &
+                ((kingside_path & occupied) == ZERO) & ((kingside_path & danger) == ZERO))
+    queenside = (can_castle & ((batch.castling & queenside_bit) != 0) &
+                 ((queenside_path & occupied) == ZERO) & ((queenside_crossed & danger) == ZERO))
+    return counts + kingside.astype(np.int64) + queenside.astype(np.int64)
@@ -15,6 +15,11 @@ SQ_SIZE = BOARD_HEIGHT // DIMENSION
 MAX_FPS = 15
 IMAGES = {}
 
+# Evaluation bar drawn under the move log, from GameState.score (no engine call needed).
+SHOW_EVAL_BAR = True
+EVAL_BAR_RECT = p.Rect(BOARD_WIDTH + 10, 360, MOVE_LOG_PANEL_WIDTH - 20, 20)
+EVAL_BAR_RANGE = 1000
+
 
 def load_images():
     '''Scales and loads the images from file to the game.
@@ -37,6 +42,8 @@ def draw_game_state(screen, gs, valid_moves, sq_selected):
     check(screen, gs)
     draw_pieces(screen, gs.board)
     draw_move_log(screen, gs)
+    if SHOW_EVAL_BAR:
+        draw_eval_bar(screen, gs)
 
 
 def draw_board(screen):
@@ -71,18 +78,15 @@ def highlight_squares(screen, gs, valid_moves, sq_selected):
                                 move.target_row * SQ_SIZE))
                     
 def check(screen, gs):
-    if gs.w_to_move and gs.in_check():
-        s = p.Surface((SQ_SIZE, SQ_SIZE))
-        s.set_alpha(100)
-        s.fill(p.Color("red"))
-        screen.blit(s, (gs.w_king_coord[1] * SQ_SIZE,
-                    gs.w_king_coord[0] * SQ_SIZE))
-    elif not gs.w_to_move and gs.in_check():
+    '''Highlights the king in red if it's in check.
+    '''
+
+    if gs.in_check():
+        king = gs.w_king_coord if gs.w_to_move else gs.b_king_coord
         s = p.Surface((SQ_SIZE, SQ_SIZE))
         s.set_alpha(100)
         s.fill(p.Color("red"))
-        screen.blit(s, (gs.b_king_coord[1] * SQ_SIZE,
-                    gs.b_king_coord[0] * SQ_SIZE))
+        screen.blit(s, (king[1] * SQ_SIZE, king[0] * SQ_SIZE))
 
 def draw_move_log(screen, gs):
     '''Draws the move log on the right side of the board.
@@ -121,6 +125,27 @@ def draw_move_log(screen, gs):
         text_y += text_object.get_height() + line_spacing
 
 
+def draw_eval_bar(screen, gs):
+    '''Draws a bar whose white part grows as the position gets better for white,
+    with the evaluation in pawns on top of it.
+    '''
+
+    score = gs.score()
+
+    # Scores beyond EVAL_BAR_RANGE centipawns fill the bar.
+    share = 0.5 + max(-EVAL_BAR_RANGE, min(EVAL_BAR_RANGE, score)) / (2 * EVAL_BAR_RANGE)
+    p.draw.rect(screen, p.Color("gray20"), EVAL_BAR_RECT)
+    p.draw.rect(screen, p.Color("white"), p.Rect(EVAL_BAR_RECT.x, EVAL_BAR_RECT.y,
+                                                 int(EVAL_BAR_RECT.w * share), EVAL_BAR_RECT.h))
+    p.draw.rect(screen, p.Color("black"), EVAL_BAR_RECT, 1)
+
+    # Writes the score in the middle of the bar.
+    eval_font = p.font.SysFont("Helvitca", 18, True, False)
+    text_object = eval_font.render("%+.2f" % (score / 100), True, p.Color("red"))
+    screen.blit(text_object, (EVAL_BAR_RECT.centerx - text_object.get_width() / 2,
+                              EVAL_BAR_RECT.centery - text_object.get_height() / 2))
+
+
 def draw_pieces(screen, board):
     '''Draws the pieces on the screen. One on each rectangle.
     '''
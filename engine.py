@@ -3,13 +3,264 @@ Sources: https://python-chess.readthedocs.io/en/v1.7.0/engine.html, https://blog
 and https://github.com/official-stockfish/Stockfish.
 '''
 
+from analysis_cache import AnalysisCache
 import chess
 import chess.engine
+from contextlib import contextmanager
 from gamestate import *
+from opening_book import OpeningBook
+import opening_book
+import os
+import queue
+import random
+import search
+import shutil
+import threading
+import time
 
 
-# Stockfish's location
-engine = chess.engine.SimpleEngine.popen_uci("/usr/local/bin/stockfish")
+# Stockfish's location: the STOCKFISH_PATH environment variable, or else the stockfish on the PATH.
+STOCKFISH_PATH = os.environ.get("STOCKFISH_PATH") or shutil.which("stockfish") or "/usr/local/bin/stockfish"
+
+# Number of Stockfish processes kept running, and the options each one gets.
+POOL_SIZE = int(os.environ.get("STOCKFISH_POOL_SIZE", 1))
+ENGINE_THREADS = int(os.environ.get("STOCKFISH_THREADS", 1))
+ENGINE_HASH = int(os.environ.get("STOCKFISH_HASH", 16))
+
+# Whether main.py starts the engine in the background as soon as the window opens,
+# instead of when the first analysis is asked for. Set STOCKFISH_PREWARM=0 to turn it off.
+ENGINE_PREWARM = os.environ.get("STOCKFISH_PREWARM", "1") != "0"
+
+# Whether the engine keeps thinking about the player's expected reply after it moves (pondering),
+# and the least time a search gets after it already spent time pondering. Set ENGINE_PONDER=0 to turn it off.
+ENGINE_PONDER = os.environ.get("ENGINE_PONDER", "1") != "0"
+PONDER_MIN_TIME = 0.1
+
+# Errors that mean an engine process died or stopped answering.
+ENGINE_ERRORS = (chess.engine.EngineError, chess.engine.EngineTerminatedError, OSError)
+
+
+class EnginePool():
+    '''Keeps a number of engine processes running, so several analyses can run at the same time
+    instead of queueing behind a single engine. An engine is checked out for each analysis and
+    checked back in afterwards; dead engines are restarted when they are checked out.
+    '''
+
+    def __init__(self, size=POOL_SIZE, command=STOCKFISH_PATH, threads=ENGINE_THREADS, hash_size=ENGINE_HASH, options=None):
+        '''size is the number of engines, and command the engine to run: a path, or a list of arguments
+        (e. g. [sys.executable, "fake_uci.py"] to run a small stand-in engine). threads and hash_size
+        set each engine's Threads and Hash (in MB) UCI options, and options any other ones.
+        Raises FileNotFoundError (or another engine error) if the engine can't be started.
+        '''
+
+        self.size = size
+        self.command = command
+        self.options = {"Threads": threads, "Hash": hash_size}
+        self.options.update(options or {})
+
+        # Engines waiting to be checked out. Every engine is either here or checked out. The engine checked in last
+        # is checked out first, so a search right after pondering gets the engine that pondered (and whose hash
+        # table already holds the position), unless another analysis gave its engine back in between.
+        self.idle = queue.LifoQueue()
+        self.restarts = 0
+        self.lock = threading.Lock()
+        engines = []
+        try:
+            for _ in range(size):
+                engines.append(self.start_engine())
+        except:
+            for engine in engines:
+                self.stop_engine(engine)
+            raise
+        for engine in engines:
+            self.idle.put(engine)
+
+        # Name and version the engine gives (e. g. "Stockfish 16"), which the analysis cache keeps apart.
+        self.name = engines[0].id.get("name", str(command)) if engines else str(command)
+
+
+    def start_engine(self):
+        '''Starts an engine process and sets the options it supports.
+        '''
+
+        engine = chess.engine.SimpleEngine.popen_uci(self.command)
+        engine.configure({name: value for name, value in self.options.items()
+                          if name in engine.options and not engine.options[name].is_managed()})
+        return engine
+
+
+    def stop_engine(self, engine):
+        '''Quits an engine, killing its process if it doesn't answer.
+        '''
+
+        try:
+            engine.quit()
+        except ENGINE_ERRORS:
+            try:
+                engine.close()
+            except ENGINE_ERRORS:
+                pass
+
+
+    def is_healthy(self, engine):
+        '''Returns True if the engine answers a ping.
+        '''
+
+        try:
+            engine.ping()
+            return True
+        except ENGINE_ERRORS:
+            return False
+
+
+    def restart(self, engine):
+        '''Replaces an engine that died or stopped answering with a new process.
+        '''
+
+        self.stop_engine(engine)
+        with self.lock:
+            self.restarts += 1
+        return self.start_engine()
+
+
+    def checkout(self, timeout=None):
+        '''Takes an engine out of the pool, waiting up to timeout seconds (forever if None) for one to be
+        free. Raises queue.Empty if none was. The engine has to be given back with checkin.
+        '''
+
+        engine = self.idle.get(timeout=timeout)
+        if not self.is_healthy(engine):
+            try:
+                engine = self.restart(engine)
+            except:
+                self.idle.put(engine)
+                raise
+        return engine
+
+
+    def checkin(self, engine):
+        '''Gives an engine back to the pool.
+        '''
+
+        self.idle.put(engine)
+
+
+    @contextmanager
+    def engine(self, timeout=None):
+        '''Checks out an engine for a with block and checks it back in afterwards.
+        '''
+
+        engine = self.checkout(timeout)
+        try:
+            yield engine
+        finally:
+            self.checkin(engine)
+
+
+    def analyse(self, board, limit, multipv=None):
+        '''Runs engine.analyse on a free engine. If the engine crashes, it is restarted
+        and the analysis is tried once more.
+        '''
+
+        engine = self.checkout()
+        try:
+            try:
+                return engine.analyse(board, limit, multipv=multipv)
+            except ENGINE_ERRORS:
+                engine = self.restart(engine)
+                return engine.analyse(board, limit, multipv=multipv)
+        finally:
+            self.checkin(engine)
+
+
+    def close(self, timeout=None):
+        '''Quits every engine in the pool, waiting up to timeout seconds (forever if None) for
+        the ones that are checked out to be checked back in.
+        '''
+
+        for _ in range(self.size):
+            try:
+                self.stop_engine(self.idle.get(timeout=timeout))
+            except queue.Empty:
+                return
+
+
+# The pool is only started when the first analysis needs it (see get_pool), so starting the program,
+# or a tool that never analyses anything, doesn't wait for Stockfish.
+pool = None
+pool_started = False
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    '''Returns the engine pool, starting it the first time. Returns None if Stockfish can't be started,
+    in which case positions are analysed by the built-in engine (search.py).
+    '''
+
+    global pool, pool_started
+    with pool_lock:
+        if not pool_started:
+            pool_started = True
+            try:
+                pool = EnginePool()
+            except ENGINE_ERRORS:
+                pool = None
+        return pool
+
+
+def prewarm():
+    '''Starts the engine pool on a background thread, so the first analysis doesn't wait for it.
+    '''
+
+    threading.Thread(target=get_pool, daemon=True).start()
+
+
+def shutdown(timeout=5):
+    '''Quits the engines, if they were started. Analyses still running should be stopped first.
+    '''
+
+    global pool, pool_started
+    with pool_lock:
+        if pool is not None:
+            pool.close(timeout)
+        pool = None
+        pool_started = False
+
+
+def engine_name():
+    '''Returns the name of the engine that analyses positions (starting the pool if it wasn't yet):
+    Stockfish's name and version, or "builtin" if search.py does the analysis.
+    '''
+
+    pool = get_pool()
+    return pool.name if pool is not None else "builtin"
+
+
+# Analyses already made, so asking again for the same position doesn't run the engine again.
+cache = AnalysisCache()
+
+# Opening book (see opening_book.py): the engine plays book moves without searching. Its location is
+# the OPENING_BOOK environment variable, or book.bin; without a book, every move is searched.
+# Like the pool, it is only opened when the first book move is asked for (see get_book).
+BOOK_PATH = os.environ.get("OPENING_BOOK", opening_book.BOOK_PATH)
+book = None
+book_opened = False
+book_lock = threading.Lock()
+
+
+def get_book():
+    '''Returns the opening book, opening it the first time. Returns None if there is no book.
+    '''
+
+    global book, book_opened
+    with book_lock:
+        if not book_opened:
+            book_opened = True
+            try:
+                book = OpeningBook(BOOK_PATH)
+            except OSError:
+                book = None
+        return book
 
 
 def analyze_position(fen, num_moves_to_return=1, depth_limit=None, time_limit=None):
@@ -26,18 +277,278 @@ def analyze_position(fen, num_moves_to_return=1, depth_limit=None, time_limit=No
         time_limit - the engine stops analyzing moves when it hits this time limit,
     '''
     
-    # Limits our search.
-    search_limit = chess.engine.Limit(depth=depth_limit, time=time_limit)
-    
-    # Creates the board from FEN.
-    board = chess.Board(fen)
-    
-    # Represents the information we want from our analysis.
-    infos = engine.analyse(board, search_limit, multipv=num_moves_to_return)
-    
-    # Returns a dictionary containing all these values.
-    return [format_info(info) for info in infos]
+    # Positions analysed before (as deep or deeper) come from the cache.
+    name = engine_name()
+    lines = cache.get(name, fen, num_moves_to_return, depth_limit, time_limit)
+    if lines is not None:
+        return lines
+
+    pool = get_pool()
+    if pool is None:
+        lines = search.analyze_position(fen, num_moves_to_return, depth_limit, time_limit)
+        depth = search.searcher.stats["depth"]
+    else:
+        # Limits our search.
+        search_limit = chess.engine.Limit(depth=depth_limit, time=time_limit)
+
+        # Creates the board from FEN.
+        board = chess.Board(fen)
+
+        # Represents the information we want from our analysis.
+        infos = pool.analyse(board, search_limit, multipv=num_moves_to_return)
+
+        # Returns a dictionary containing all these values.
+        lines = [format_info(info) for info in infos]
+        depth = min(info.get("depth", 0) for info in infos) if infos else 0
+
+    if lines:
+        cache.put(name, fen, num_moves_to_return, depth_limit, time_limit, depth, lines)
+    return lines
    
+
+def stream_analysis(fen, num_moves_to_return=1, depth_limit=None, time_limit=None, on_start=None):
+    '''Analyses the position like analyze_position, but yields the analysis as it improves: a dictionary with
+    the depth every line was searched to, the nodes searched so far, the nodes per second, and lines (what
+    analyze_position returns). Without a depth or time limit, it only stops when the engine is told to.
+    on_start, if given, is called with a function that stops the analysis once it is running.
+    '''
+
+    pool = get_pool()
+    if pool is None:
+        gs = GameState()
+        gs.load_fen(fen)
+        search.searcher.stop_requested.clear()
+        if on_start is not None:
+            on_start(search.searcher.stop)
+        for depth, results in search.searcher.iterate(gs, num_moves_to_return, depth_limit, time_limit):
+            yield {"depth": depth, "nodes": search.searcher.stats["nodes"], "nps": search.searcher.stats["nps"],
+                   "lines": [search.format_result(score, pv, gs.w_to_move) for score, pv in results]}
+        return
+
+    with pool.engine() as engine:
+        with engine.analysis(chess.Board(fen), chess.engine.Limit(depth=depth_limit, time=time_limit),
+                             multipv=num_moves_to_return) as analysis:
+            if on_start is not None:
+                on_start(analysis.stop)
+            for info in analysis:
+
+                # Only lines with a score and moves are shown (the engine also reports e. g. the move it's on).
+                if "score" not in info or "pv" not in info:
+                    continue
+                lines = [line for line in analysis.multipv if "score" in line and "pv" in line]
+                yield {"depth": min(line.get("depth", 0) for line in lines), "nodes": info.get("nodes", 0),
+                       "nps": info.get("nps", 0), "lines": [format_info(line) for line in lines]}
+
+
+class AnalysisWorker():
+    '''Analyses positions on a background thread, so the window keeps drawing and reading input while
+    the engine thinks. Requests are queued with submit, and analyses are picked up with poll.
+    '''
+
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+
+        # Requests are numbered. Cancelling drops every request up to the last one submitted,
+        # and stop_current stops the analysis that is running, if any.
+        self.lock = threading.Lock()
+        self.last_request = 0
+        self.last_cancelled = 0
+        self.stop_current = None
+
+        # The request that is pondering (if any), the position it ponders (as an EPD, which leaves out the
+        # move counters), when it started, its number of lines and its latest update.
+        self.ponder_request = None
+        self.ponder_position = None
+        self.ponder_start = 0.0
+        self.ponder_multipv = 0
+        self.ponder_update = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def submit(self, tag, fen, num_moves_to_return=1, depth_limit=None, time_limit=None, stream=False, use_book=False):
+        '''Cancels any analysis in progress and queues a new one, with the same parameters as stream_analysis.
+        tag says what the result is for (e. g. "move" or "eval"); poll returns it with the result. If stream
+        is True, every update of the analysis is returned, not just the final one. If use_book is True and the
+        position is in the opening book, the result is a single line with a book move and no score.
+
+        If the engine was pondering this position and already searched as deep or as long as asked, what it
+        found answers the request straight away (the worker thread also saves it in the cache). Otherwise the search
+        starts again, with what the engine learnt while pondering still in its hash, and the time spent pondering
+        comes off the time limit.
+        '''
+
+        with self.lock:
+            hit = self.is_pondering(fen)
+            elapsed = time.perf_counter() - self.ponder_start
+            update = self.ponder_update
+        answer = None
+        if hit:
+            if (update is not None and update["lines"] and self.ponder_multipv >= num_moves_to_return and
+                    ((depth_limit is not None and update["depth"] >= depth_limit) or (time_limit is not None and elapsed >= time_limit))):
+                answer = dict(update, lines=update["lines"][:num_moves_to_return])
+            elif time_limit is not None:
+                time_limit = max(time_limit - elapsed, PONDER_MIN_TIME)
+
+        self.cancel()
+        with self.lock:
+            self.last_request += 1
+            self.requests.put((self.last_request, tag, fen, num_moves_to_return, depth_limit, time_limit, stream, use_book, answer))
+
+
+    def ponder(self, fen, reply, num_moves_to_return=1):
+        '''Starts thinking, without limits, about the position after the move reply (in UCI notation) is played
+        from fen, until the player moves. Its results aren't returned by poll; they're used by the next
+        submit if the player played reply.
+        '''
+
+        board = chess.Board(fen)
+        try:
+            board.push_uci(reply)
+        except ValueError:
+            return
+        self.cancel()
+        with self.lock:
+            self.last_request += 1
+            self.ponder_request = self.last_request
+            self.ponder_position = board.epd()
+            self.ponder_start = time.perf_counter()
+            self.ponder_multipv = num_moves_to_return
+            self.ponder_update = None
+            self.requests.put((self.last_request, "ponder", board.fen(), num_moves_to_return, None, None, True, False, None))
+
+
+    def is_pondering(self, fen):
+        '''Returns True if the engine is pondering the position in fen. Must be called with the lock held.
+        '''
+
+        return (self.ponder_request is not None and self.ponder_request > self.last_cancelled and
+                chess.Board(fen).epd() == self.ponder_position)
+
+
+    def moved(self, fen):
+        '''Tells the worker the player made a move, reaching fen. The analysis in progress is cancelled,
+        unless it is pondering this very position (a ponder hit), in which case it keeps going.
+        '''
+
+        with self.lock:
+            hit = self.is_pondering(fen)
+        if not hit:
+            self.cancel()
+
+
+    def cancel(self):
+        '''Drops the queued requests and stops the one being analysed. Their results are never returned.
+        '''
+
+        with self.lock:
+            self.last_cancelled = self.last_request
+            if self.stop_current is not None:
+                self.stop_current()
+
+            # Results that finished but weren't picked up yet are dropped too.
+            self.poll()
+
+
+    def is_busy(self):
+        '''Returns True while a request is waiting or being analysed.
+        '''
+
+        with self.lock:
+            return (self.last_request > self.last_cancelled and self.last_request != self.ponder_request and
+                    (self.stop_current is not None or not self.requests.empty()))
+
+
+    def poll(self):
+        '''Returns the (tag, analysis) pairs that arrived since the last call, without waiting. The analysis is
+        a dictionary like the ones stream_analysis yields (depth is None if it came from the cache),
+        or None if the engine failed or there are no legal moves.
+        '''
+
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+
+    def started(self, request, stop):
+        '''Keeps the function that stops the running analysis, and calls it straight away if the request
+        was cancelled before the analysis started.
+        '''
+
+        with self.lock:
+            self.stop_current = stop
+            if request <= self.last_cancelled:
+                stop()
+
+
+    def send(self, request, tag, update):
+        '''Hands an analysis to the main thread, unless its request was cancelled. Pondering updates are kept
+        for submit instead.
+        '''
+
+        with self.lock:
+            if request == self.ponder_request:
+                if update is not None:
+                    self.ponder_update = update
+            elif request > self.last_cancelled:
+                self.results.put((tag, update))
+
+
+    def run(self):
+        '''Analyses the requests one at a time, on the worker thread.
+        '''
+
+        while True:
+            request, tag, fen, num_moves_to_return, depth_limit, time_limit, stream, use_book, answer = self.requests.get()
+            if request <= self.last_cancelled:
+                continue
+
+            # A ponder hit that already searched far enough is answered with what pondering found, which is kept
+            # in the cache here rather than on the thread that submitted it (writing analysis.db takes a while).
+            if answer is not None:
+                cache.put(engine_name(), fen, num_moves_to_return, depth_limit, time_limit, answer["depth"], answer["lines"])
+                self.send(request, tag, answer)
+                continue
+
+            # Book positions are answered from the opening book, without the engine.
+            opening = get_book() if use_book else None
+            move = opening.choose_move(fen) if opening is not None else None
+            if move is not None:
+                self.send(request, tag, {"depth": None, "nodes": 0, "nps": 0,
+                                         "lines": [{"mate_score": None, "centipawn_score": None, "pv": [move]}]})
+                continue
+
+            # Positions analysed before (as deep or deeper) come from the cache.
+            name = engine_name()
+            lines = cache.get(name, fen, num_moves_to_return, depth_limit, time_limit)
+            if lines is not None:
+                self.send(request, tag, {"depth": None, "nodes": 0, "nps": 0, "lines": lines})
+                continue
+
+            update = None
+            try:
+                for update in stream_analysis(fen, num_moves_to_return, depth_limit, time_limit,
+                                              lambda stop: self.started(request, stop)):
+                    if stream:
+                        self.send(request, tag, update)
+            except ENGINE_ERRORS:
+                update = None
+            with self.lock:
+                self.stop_current = None
+            if update is None or not stream:
+                self.send(request, tag, update)
+
+            # Only analyses that weren't stopped early are worth keeping.
+            with self.lock:
+                if update is not None and request > self.last_cancelled:
+                    cache.put(name, fen, num_moves_to_return, depth_limit, time_limit, update["depth"], update["lines"])
+
+
 def format_info(info):
     '''Called by analyze_position to initiliase a dict
     containing the engine's analysis.
@@ -56,6 +567,30 @@ def format_info(info):
     }
 
 
+def choose_line(eng_evaluation):
+    '''To avoid playing the same moves all the time, checks if the best moves are similar in evaluation
+    and picks one randomly. Also plays any moves that lead to mate instantly, and book moves (which have no score) as they are.
+    '''
+
+    if eng_evaluation[0]["mate_score"] != None or eng_evaluation[0]["centipawn_score"] == None:
+        return eng_evaluation[0]
+
+    # Lines within 25 centipawns of the best one (mating lines have no centipawn score).
+    close = [line for line in eng_evaluation if line["centipawn_score"] != None and line["pv"]
+             and abs(line["centipawn_score"] - eng_evaluation[0]["centipawn_score"]) < 25]
+    return random.choice(close)
+
+
+def describe_line(line):
+    '''Returns a line of the analysis as text, e. g. "White has mate in 3 (d1h5)" or "35 centipawns (e2e4)".
+    '''
+
+    if line["mate_score"] != None:
+        return ("White" if line["mate_score"] > 0 else "Black") + " has mate in " + \
+            str(abs(line["mate_score"])) + " (" + line["pv"][0] + ")"
+    return str(line["centipawn_score"]) + " centipawns (" + line["pv"][0] + ")"
+
+
 def format_moves(pv):
     '''Converts the move class to a standard string.
     '''
@@ -75,7 +75,7 @@ class FenParser():
         return index
     
     
-    '''The four methods below search for the special fields in
+    '''The five methods below search for the special fields in
     the FEN string and return their value.
     '''   
     
@@ -92,6 +92,13 @@ class FenParser():
         return castle
     
     
+    def en_passant(self):
+        start = self.find_nth(self.fen_str, " ", 3)
+        end = self.find_nth(self.fen_str, " ", 4)
+        en_passant = self.fen_str[start + 1:end] if end != -1 else self.fen_str[start + 1:]
+        return en_passant
+
+
     def halfmove_clock(self):
         start = self.find_nth(self.fen_str, " ", 4)
         end = self.find_nth(self.fen_str, " ", 5)
@@ -2,6 +2,13 @@
 and https://github.com/official-stockfish/Stockfish
 '''
 
+from attack_tables import *
+from evaluation import *
+from fen_parser import FenParser
+from move_cache import MoveCache
+import random
+import struct
+
 # Since the board's coordinates are inverted, these
 # dictionaries allow some functions to convert the
 # coordinates on the board to proper chess notation.
@@ -13,16 +20,132 @@ files_to_cols = {"a": 0, "b": 1, "c": 2, "d": 3,
 cols_to_files = {v: k for k, v in files_to_cols.items()}
 
 
+# Pieces a pawn can promote to. The queen comes first since it's what the board plays.
+PROMOTION_PIECES = ["Q", "R", "B", "N"]
+
+# Moves are packed into 16-bit ints: bits 0-5 are the start square, bits 6-11 the
+# target square and bits 12-15 a flag. Promotions use FLAG_PROMOTION plus the index of
+# the piece in PROMOTION_PIECES, so any flag >= FLAG_PROMOTION is a promotion.
+FLAG_EP = 1
+FLAG_CASTLE = 2
+FLAG_PROMOTION = 4
+
+# The pieces, as they appear on the board. Each has its own bitboard (see attack_tables.py).
+PIECES = ["wP", "wN", "wB", "wR", "wQ", "wK", "bP", "bN", "bB", "bR", "bQ", "bK"]
+
+
+# Zobrist keys: one random 64-bit number per piece on each square, per castling rights
+# combination, per en passant file, and one for black to move. A position's key is the XOR
+# of the numbers of everything in it, so a move only XORs in and out what it changed.
+# The seed is fixed so the keys (and any stored hashes) are the same in every process.
+zobrist_random = random.Random(20221128)
+ZOBRIST_PIECES = {piece: [zobrist_random.getrandbits(64) for _ in range(64)] for piece in PIECES}
+ZOBRIST_CASTLING = [zobrist_random.getrandbits(64) for _ in range(16)]
+ZOBRIST_EP = [zobrist_random.getrandbits(64) for _ in range(8)]
+ZOBRIST_BLACK_TO_MOVE = zobrist_random.getrandbits(64)
+
+
+# Castling rights are kept as a number from 0 to 15, with one bit for each right.
+WKS, WQS, BKS, BQS = 1, 2, 4, 8
+
+# Rights kept when a piece moves from or to each square: moving the king or a rook, or capturing
+# a rook on its starting square, loses the matching rights (a8 = 0, h8 = 7, e8 = 4, a1 = 56, h1 = 63, e1 = 60).
+CASTLING_MASKS = [15] * 64
+CASTLING_MASKS[0] = 15 ^ BQS
+CASTLING_MASKS[4] = 15 ^ BKS ^ BQS
+CASTLING_MASKS[7] = 15 ^ BKS
+CASTLING_MASKS[56] = 15 ^ WQS
+CASTLING_MASKS[60] = 15 ^ WKS ^ WQS
+CASTLING_MASKS[63] = 15 ^ WKS
+
+
+def castling_index(rights):
+    '''Packs CastleRights into a number from 0 to 15 (wks, wqs, bks, bqs bits).
+    '''
+
+    return rights.wks | rights.wqs << 1 | rights.bks << 2 | rights.bqs << 3
+
+
+def ep_key(ep_possible):
+    '''Returns the Zobrist key of an en passant square, which only depends on its file.
+    '''
+
+    return ZOBRIST_EP[ep_possible[1]] if ep_possible else 0
+
+
+# Layout of GameState.snapshot's records: the piece on each square (0 if empty, else its index
+# in PIECES plus one), the player to move (1 for white), the castling rights, the en passant
+# square (255 if none), the halfmove clock and the fullmove number. 71 bytes in all.
+SNAPSHOT_FORMAT = struct.Struct("<64sBBBHH")
+NO_EP_SQUARE = 255
+
+
+# Legal move lists of the positions seen most recently, shared by every GameState.
+MOVE_CACHE = MoveCache()
+
+
 class GameState():
     '''Handles most information about the current gamestate. It determines the valid moves in the position, piece placement and move log.
+    The position is stored as one bitboard per piece, and the 2D list board is kept as a view of it.
     '''
 
+    # Cache of legal move lists shared by every GameState in the process. It can be
+    # resized with MOVE_CACHE.resize, or set to None (per instance or here) to disable it.
+    move_cache = MOVE_CACHE
+
     def __init__(self):
 
+        # One bitboard for each piece and one for all the pieces of each colour. The colour
+        # bitboards are the sets of occupied squares the move generator iterates over,
+        # and the kings' coordinates are read from the king bitboards.
+        self.pieces = {piece: 0 for piece in PIECES}
+        self.occupancy = {"w": 0, "b": 0}
+
+        # Zobrist key of the position, updated by put_piece and remove_piece as pieces
+        # move, and by make_move for the turn, castling rights and en passant.
+        self.zobrist_key = 0
+
+        # Middlegame and endgame scores (material plus piece-square tables) and the game phase,
+        # also updated by put_piece and remove_piece, so score() never has to scan the board.
+        self.mg_score = 0
+        self.eg_score = 0
+        self.phase = 0
+
+        # Dictionary containing the return values of all the different move functions.
+        self.move_functions = {"P": self.pawn_moves, "N": self.knight_moves, "B": self.bishop_moves,
+                               "R": self.rook_moves, "Q": self.queen_moves, "K": self.king_moves}
+
+        # Keeps track of whose turn it is.
+        self.w_to_move = True
+
+        # Initiliases a move log that's later used for notating the moves played.
+        self.move_log = []
+
+        # Everything a move can't take back by itself, saved by make_move before each move so
+        # undo_move can restore it exactly: one (captured piece, castling rights, en passant,
+        # halfmove clock, Zobrist key) tuple per move in move_log.
+        self.undo_log = []
+
+        # Keeps track of checkmate and stalemate.
+        self.checkmate = False
+        self.stalemate = False
+
+        # Stores possible en passant.
+        self.ep_possible = ()
+
+        # Sets both queenside and kingside castling for white and black to true (WKS | WQS | BKS | BQS).
+        self.castling_rights = 15
+
+        # Number of moves since the last capture or pawn move, and the number of halfmoves played
+        # before the position the game was set up from (see fullmove_number).
+        self.halfmove_clock = 0
+        self.start_ply = 0
+
         # Initialises a 2D list with each piece's placement.
         # Notice how its indices start from the top left, and not from the bottom right,
         # which would be the proper chessboard configuration. Collumns also have numerical indices,
         # and not alphabetical. These are all dealt with in the Move class.
+        # Assigning the board also sets up the bitboards and the Zobrist key (see the board setter below).
         self.board = [
             ["bR", "bN", "bB", "bQ", "bK", "bB", "bN", "bR"],
             ["bP", "bP", "bP", "bP", "bP", "bP", "bP", "bP"],
@@ -34,44 +157,301 @@ class GameState():
             ["wR", "wN", "wB", "wQ", "wK", "wB", "wN", "wR"],
         ]
 
-        # Dictionary containing the return values of all the different move functions.
-        self.move_functions = {"P": self.pawn_moves, "N": self.knight_moves, "B": self.bishop_moves,
-                               "R": self.rook_moves, "Q": self.queen_moves, "K": self.king_moves}
 
-        # Keeps track of whose turn it is.
-        self.w_to_move = True
+    def reset_zobrist(self):
+        '''Computes the Zobrist key from scratch. Only needed when the
+        position is set up directly instead of through make_move.
+        '''
 
-        # Initiliases a move log that's later used for notating the moves played.
-        self.move_log = []
+        key = 0
+        for piece in PIECES:
+            bb = self.pieces[piece]
+            while bb:
+                sq = (bb & -bb).bit_length() - 1
+                bb &= bb - 1
+                key ^= ZOBRIST_PIECES[piece][sq]
+        key ^= ZOBRIST_CASTLING[self.castling_rights]
+        if not self.w_to_move:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        self.zobrist_key = key ^ self.ep_hash()
+
+
+    def ep_hash(self):
+        '''Returns the part of the Zobrist key that depends on en passant. As in Polyglot, the en passant file
+        only counts if a pawn of the player to move stands next to the pawn that can be taken; otherwise
+        the position right after a double push would never count as a repetition of a later one.
+        '''
 
-        # Keeps track of the kings' coordinates.
-        self.w_king_coord = [7, 4]
-        self.b_king_coord = [0, 4]
+        if not self.ep_possible:
+            return 0
+        row, col = self.ep_possible
+        pawn_row = row + 1 if self.w_to_move else row - 1
+        beside = (1 << (pawn_row * 8 + col - 1) if col > 0 else 0) | (1 << (pawn_row * 8 + col + 1) if col < 7 else 0)
+        return ep_key(self.ep_possible) if self.pieces["wP" if self.w_to_move else "bP"] & beside else 0
 
-        # Keeps track of checkmate and stalemate.
+
+    def load_fen(self, fen):
+        '''Sets up the position from a FEN string read by FenParser, resetting the logs.
+        Raises ValueError if the FEN isn't valid, in which case the position is left as it was.
+        '''
+
+        # Reads and checks every field before changing anything.
+        fp = FenParser(fen)
+        try:
+            fields = fen.split()
+            if len(fields) < 4:
+                raise ValueError("a FEN needs at least 4 fields")
+            board = fp.parse()
+            if len(board) != 8 or any(len(row) != 8 for row in board):
+                raise ValueError("the board needs 8 ranks of 8 squares")
+            if sum(row.count("wK") for row in board) != 1 or sum(row.count("bK") for row in board) != 1:
+                raise ValueError("each side needs exactly one king")
+            turn = fp.turn()
+            if turn not in ("w", "b"):
+                raise ValueError("the side to move must be w or b")
+            castle = fp.castle()
+            if castle != "-" and (not castle or set(castle) - set("KQkq")):
+                raise ValueError("invalid castling rights")
+            ep = fp.en_passant()
+            if ep != "-" and len(ep) != 2:
+                raise ValueError("invalid en passant square")
+            ep_possible = () if ep == "-" else (ranks_to_rows[ep[1]], files_to_cols[ep[0]])
+        except (IndexError, KeyError) as error:
+            raise ValueError("invalid FEN: " + fen) from error
+
+        # Some FEN records leave out the move counters.
+        w_to_move = turn == "w"
+        try:
+            halfmove_clock = fp.halfmove_clock()
+            start_ply = (fp.fullmove_number() - 1) * 2 + (not w_to_move)
+        except ValueError:
+            halfmove_clock = 0
+            start_ply = not w_to_move
+
+        self.board = board
+        self.w_to_move = w_to_move
+        self.current_castling_rights = CastleRights("K" in castle, "k" in castle, "Q" in castle, "q" in castle)
+        self.ep_possible = ep_possible
+        self.halfmove_clock = halfmove_clock
+        self.start_ply = start_ply
+        self.move_log = []
+        self.undo_log = []
         self.checkmate = False
         self.stalemate = False
+        self.reset_zobrist()
 
-        # Stores possible en passant.
-        self.ep_possible = ()
 
-        # Sets both queenside and kingside castling for white and black to true.
-        self.current_castling_rights = CastleRights(True, True, True, True)
+    def snapshot(self):
+        '''Packs the position into a fixed-size bytes record (see SNAPSHOT_FORMAT), which is cheap to
+        send to other processes or store. The move history isn't included.
+        '''
 
-        # Logs castling rights.
-        self.castling_rights_log = [CastleRights(self.current_castling_rights.wks, self.current_castling_rights.bks,
-                                                 self.current_castling_rights.wqs, self.current_castling_rights.bqs)]
+        squares = bytearray(64)
+        for i, piece in enumerate(PIECES):
+            bb = self.pieces[piece]
+            while bb:
+                sq = (bb & -bb).bit_length() - 1
+                bb &= bb - 1
+                squares[sq] = i + 1
+        ep_square = self.ep_possible[0] * 8 + self.ep_possible[1] if self.ep_possible else NO_EP_SQUARE
+        return SNAPSHOT_FORMAT.pack(bytes(squares), self.w_to_move, self.castling_rights, ep_square,
+                                    self.halfmove_clock, self.fullmove_number)
+
+
+    @classmethod
+    def from_snapshot(cls, record):
+        '''Returns a new GameState with the position packed by snapshot.
+        '''
 
+        squares, w_to_move, castling_rights, ep_square, halfmove_clock, fullmove_number = SNAPSHOT_FORMAT.unpack(record)
+        gs = cls()
+        gs.w_to_move = bool(w_to_move)
+        gs.castling_rights = castling_rights
+        gs.ep_possible = () if ep_square == NO_EP_SQUARE else (ep_square >> 3, ep_square & 7)
+        gs.halfmove_clock = halfmove_clock
+        gs.start_ply = (fullmove_number - 1) * 2 + (not gs.w_to_move)
+        gs.board = [[PIECES[squares[r * 8 + c] - 1] if squares[r * 8 + c] else "--" for c in range(8)] for r in range(8)]
+        return gs
 
-    def make_move(self, move):
-        '''Makes the moves on the board by changing the appropriate elements on the list board.
+
+    def clone(self):
+        '''Returns a copy of the position without its history (the logs start empty), without
+        going through __init__ and the board setter. Every attribute set in __init__ needs to be set here too.
+        '''
+
+        gs = GameState.__new__(GameState)
+        gs.pieces = self.pieces.copy()
+        gs.occupancy = self.occupancy.copy()
+        gs._board = [row[:] for row in self._board]
+        gs.zobrist_key = self.zobrist_key
+        gs.mg_score = self.mg_score
+        gs.eg_score = self.eg_score
+        gs.phase = self.phase
+        gs.move_functions = {"P": gs.pawn_moves, "N": gs.knight_moves, "B": gs.bishop_moves,
+                             "R": gs.rook_moves, "Q": gs.queen_moves, "K": gs.king_moves}
+        gs.w_to_move = self.w_to_move
+        gs.move_log = []
+        gs.undo_log = []
+        gs.checkmate = self.checkmate
+        gs.stalemate = self.stalemate
+        gs.ep_possible = self.ep_possible
+        gs.castling_rights = self.castling_rights
+        gs.halfmove_clock = self.halfmove_clock
+        gs.start_ply = self.start_ply + len(self.move_log)
+        return gs
+
+
+    @property
+    def fullmove_number(self):
+        '''Number of the current move, which goes up after each of black's moves.
+        '''
+
+        return (self.start_ply + len(self.move_log)) // 2 + 1
+
+
+    @property
+    def board(self):
+        '''2D list view of the bitboards. It is updated together with them by
+        put_piece and remove_piece, and is what chessboard.draw_pieces reads.
+        '''
+
+        return self._board
+
+
+    @board.setter
+    def board(self, board):
+        '''Sets up the position from a 2D list (e. g. the one returned by FenParser.parse)
+        and derives the bitboards and the Zobrist key from it.
+        '''
+
+        self._board = [["--"] * 8 for _ in range(8)]
+        self.pieces = {piece: 0 for piece in PIECES}
+        self.occupancy = {"w": 0, "b": 0}
+        self.mg_score = self.eg_score = self.phase = 0
+        for r in range(8):
+            for c in range(8):
+                if board[r][c] != "--":
+                    self.put_piece(board[r][c], r * 8 + c)
+        self.reset_zobrist()
+
+
+    @property
+    def current_castling_rights(self):
+        '''Castling rights as a CastleRights object, read from the castling_rights bits.
+        '''
+
+        rights = self.castling_rights
+        return CastleRights(bool(rights & WKS), bool(rights & BKS), bool(rights & WQS), bool(rights & BQS))
+
+
+    @current_castling_rights.setter
+    def current_castling_rights(self, rights):
+        self.castling_rights = castling_index(rights)
+
+
+    @property
+    def w_king_coord(self):
+        '''White king's [row, col], read from its bitboard.
+        '''
+
+        sq = self.pieces["wK"].bit_length() - 1
+        return [sq >> 3, sq & 7]
+
+
+    @property
+    def b_king_coord(self):
+        '''Black king's [row, col], read from its bitboard.
+        '''
+
+        sq = self.pieces["bK"].bit_length() - 1
+        return [sq >> 3, sq & 7]
+
+
+    def piece_squares(self, color):
+        '''Returns a list of (piece, square index) for every piece of the given colour,
+        read from the bitboards without scanning the empty squares.
+        '''
+
+        squares = []
+        for piece in PIECES:
+            if piece[0] == color:
+                bb = self.pieces[piece]
+                while bb:
+                    sq = (bb & -bb).bit_length() - 1
+                    bb &= bb - 1
+                    squares.append((piece, sq))
+        return squares
+
+
+    def put_piece(self, piece, sq):
+        '''Places a piece on an empty square, updating the bitboards, the board view, the Zobrist key and the evaluation.
+        '''
+
+        bit = 1 << sq
+        self.pieces[piece] |= bit
+        self.occupancy[piece[0]] |= bit
+        self._board[sq >> 3][sq & 7] = piece
+        self.zobrist_key ^= ZOBRIST_PIECES[piece][sq]
+        self.mg_score += MG_SQUARE_SCORES[piece][sq]
+        self.eg_score += EG_SQUARE_SCORES[piece][sq]
+        self.phase += PHASES[piece]
+
+
+    def remove_piece(self, sq):
+        '''Removes the piece on the given square and returns it.
+        '''
+
+        piece = self._board[sq >> 3][sq & 7]
+        bit = 1 << sq
+        self.pieces[piece] ^= bit
+        self.occupancy[piece[0]] ^= bit
+        self._board[sq >> 3][sq & 7] = "--"
+        self.zobrist_key ^= ZOBRIST_PIECES[piece][sq]
+        self.mg_score -= MG_SQUARE_SCORES[piece][sq]
+        self.eg_score -= EG_SQUARE_SCORES[piece][sq]
+        self.phase -= PHASES[piece]
+        return piece
+
+
+    def score(self):
+        '''Returns the evaluation of the position in centipawns, from white's point of view
+        (see evaluation.py). The scores are kept up to date as pieces move, so this is O(1).
         '''
 
-        # Sets the square the piece moved from to empty.
-        self.board[move.start_row][move.start_col] = "--"
+        return taper(self.mg_score, self.eg_score, self.phase)
 
-        # Moves the piece to its target square.
-        self.board[move.target_row][move.target_col] = move.piece_moved
+
+    def make_move(self, move):
+        '''Makes the moves on the board by moving the piece on the bitboards (and therefore on the board view).
+        The move can be a Move or its packed int code; whichever is given is appended to the move log.
+        '''
+
+        code = move if type(move) is int else move.code
+        start = code & 63
+        target = code >> 6 & 63
+        flag = code >> 12
+        board = self._board
+        key = self.zobrist_key
+        old_ep_hash = self.ep_hash()
+
+        # Removes the captured piece. En passant captures the pawn beside the start square.
+        if flag == FLAG_EP:
+            captured = self.remove_piece((start & 56) | (target & 7))
+        else:
+            captured = board[target >> 3][target & 7]
+            if captured != "--":
+                self.remove_piece(target)
+
+        # Saves what the move can't take back by itself, so undo_move can restore it.
+        self.undo_log.append((captured, self.castling_rights, self.ep_possible, self.halfmove_clock, key))
+
+        # Moves the piece to its target square, promoting the pawn if it reached the last rank.
+        # TODO: allow the user to promote to other pieces (the board always asks for a queen).
+        piece = self.remove_piece(start)
+        if flag >= FLAG_PROMOTION:
+            self.put_piece(piece[0] + PROMOTION_PIECES[flag - FLAG_PROMOTION], target)
+        else:
+            self.put_piece(piece, target)
 
         # Appends the move to the move log.
         self.move_log.append(move)
@@ -79,230 +459,469 @@ class GameState():
         # Switches turns.
         self.w_to_move = not self.w_to_move
 
-        # Changes kings' coordinates if they move.
-        if move.piece_moved == "wK":
-            self.w_king_coord[0] = move.target_row
-            self.w_king_coord[1] = move.target_col
-        elif move.piece_moved == "bK":
-            self.b_king_coord[0] = move.target_row
-            self.b_king_coord[1] = move.target_col
-
-        # Promotes the pawn to a queen.
-        # TODO: allow the user to promote to other pieces.
-        if move.is_pawn_promotion:
-            self.board[move.target_row][move.target_col] = move.piece_moved[0] + "Q"
-
-        # Accounts for en passant.
-        if move.is_ep:
-            self.board[move.start_row][move.target_col] = "--"
+        # Captures and pawn moves reset the halfmove clock.
+        if piece[1] == "P" or captured != "--":
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
 
         # Checks if en passant is possible and adds it to ep_possible.
-        if move.piece_moved[1] == "P" and abs(move.start_row - move.target_row) == 2:
-            self.ep_possible = (
-                (move.start_row + move.target_row)//2, move.start_col)
+        if piece[1] == "P" and abs(start - target) == 16:
+            self.ep_possible = ((start + target) >> 4, start & 7)
         else:
             self.ep_possible = ()
 
-        # Moves the king and the rook to castle and updates castling rights.
-        if move.is_castle:
-            if move.target_col - move.start_col == 2:
-                self.board[move.target_row][move.target_col -
-                                            1] = self.board[move.target_row][move.target_col + 1]
-                self.board[move.target_row][move.target_col + 1] = "--"
+        # Moves the rook to castle and updates castling rights.
+        if flag == FLAG_CASTLE:
+            if target - start == 2:
+                self.put_piece(self.remove_piece(target + 1), target - 1)
             else:
-                self.board[move.target_row][move.target_col +
-                                            1] = self.board[move.target_row][move.target_col - 2]
-                self.board[move.target_row][move.target_col - 2] = "--"
-        self.update_castle_rights(move)
-        self.castling_rights_log.append(CastleRights(self.current_castling_rights.wks, self.current_castling_rights.bks,
-                                                     self.current_castling_rights.wqs, self.current_castling_rights.bqs))
+                self.put_piece(self.remove_piece(target - 2), target + 1)
+        old_rights = self.castling_rights
+        self.update_castle_rights(start, target)
+
+        # The pieces' keys were already updated as they moved; this swaps the turn,
+        # the castling rights and the en passant file.
+        self.zobrist_key ^= (ZOBRIST_BLACK_TO_MOVE ^ old_ep_hash ^ self.ep_hash() ^
+                             ZOBRIST_CASTLING[old_rights] ^ ZOBRIST_CASTLING[self.castling_rights])
 
 
     def get_valid_moves(self):
-        '''Generates all valid moves in the position by making all possible moves and
-        removing those who lead to checks.
-        '''
-        
-        temp_ep_possible = self.ep_possible
-        temp_castle_rights = CastleRights(self.current_castling_rights.wks, self.current_castling_rights.bks,
-                                          self.current_castling_rights.wqs, self.current_castling_rights.bqs)
-        moves = self.possible_moves()
-        for i in range(len(moves) - 1, -1, -1):
-            self.make_move(moves[i])
-            self.w_to_move = not self.w_to_move
-            if self.in_check():
-                moves.remove(moves[i])
-            self.w_to_move = not self.w_to_move
-            self.undo_move()
+        '''Returns the valid moves in the position as Move objects, which is what the board
+        and the move log need. Code that only plays moves (e. g. perft) should use legal_moves.
+        The moves (and checkmate/stalemate) are looked up in move_cache first, by Zobrist key.
+        '''
+
+        if self.move_cache is None:
+            codes = self.legal_moves()
+        else:
+            entry = self.move_cache.get(self.zobrist_key)
+            if entry is None:
+                codes = self.legal_moves()
+                self.move_cache.put(self.zobrist_key, (tuple(codes), self.checkmate, self.stalemate))
+            else:
+                codes, self.checkmate, self.stalemate = entry
+        return [Move.from_code(code, self._board) for code in codes]
+
+
+    def legal_moves(self):
+        '''Generates all valid moves in the position as packed int codes. Instead of making every possible move and
+        removing those who lead to checks, it finds the checkers and pinned pieces once and
+        only generates moves that keep the king safe:
+            - the king can only go to squares the opponent doesn't attack;
+            - in double check, only the king can move;
+            - in single check, other pieces must capture the checker or block its ray;
+            - pinned pieces can only move along the line between the king and the pinner.
+        '''
+
+        color, enemy = ("w", "b") if self.w_to_move else ("b", "w")
+        own = self.occupancy[color]
+        occupied = own | self.occupancy[enemy]
+        king = self.pieces[color + "K"]
+        king_sq = king.bit_length() - 1
+        kr, kc = king_sq >> 3, king_sq & 7
+        moves = []
+
+        # Squares attacked by the opponent. The king is taken off the board so it
+        # can't "hide" behind itself by stepping back along a checking ray.
+        danger = self.attack_map(enemy, occupied ^ king)
+        self.add_moves(king_sq, KING_ATTACKS[king_sq] & ~own & ~danger, moves)
+
+        checkers = self.attackers_to(king_sq, enemy, occupied)
+        if checkers & (checkers - 1) == 0:
+
+            # Pieces other than the king must capture the checker or block its ray.
+            if checkers:
+                evasion = checkers | BETWEEN[king_sq][checkers.bit_length() - 1]
+            else:
+                evasion = ALL_SQUARES
+            pins = self.pins(king_sq, color, enemy, occupied)
+            self.pawn_legal_moves(color, enemy, king_sq, occupied, evasion, pins, moves)
+            for piece in "NBRQ":
+                bb = self.pieces[color + piece]
+                while bb:
+                    sq = (bb & -bb).bit_length() - 1
+                    bb &= bb - 1
+                    if piece == "N":
+                        targets = KNIGHT_ATTACKS[sq]
+                    elif piece == "B":
+                        targets = bishop_attacks(sq, occupied)
+                    elif piece == "R":
+                        targets = rook_attacks(sq, occupied)
+                    else:
+                        targets = bishop_attacks(sq, occupied) | rook_attacks(sq, occupied)
+                    targets &= evasion & ~own
+                    if sq in pins:
+                        targets &= pins[sq]
+                    self.add_moves(sq, targets, moves)
+
+            # The king can't castle out of check.
+            if not checkers:
+                self.castling(kr, kc, moves, danger)
+
+        self.checkmate = False
+        self.stalemate = False
         if len(moves) == 0:
-            if self.in_check():
+            if checkers:
                 self.checkmate = True
             else:
                 self.stalemate = True
+        return moves
 
-        if self.w_to_move:
-            self.castling(self.w_king_coord[0], self.w_king_coord[1], moves)
+
+    def pawn_legal_moves(self, color, enemy, king_sq, occupied, evasion, pins, moves):
+        '''Generates the legal pawn moves for legal_moves, given the check evasion mask and the pins.
+        En passant is tested separately, since it removes two pieces from the same rank and can uncover a check.
+        '''
+
+        step, start_row = (-8, 6) if color == "w" else (8, 1)
+        attacks = PAWN_ATTACKS[color]
+        enemies = self.occupancy[enemy]
+        ep_bit = 1 << (self.ep_possible[0] * 8 + self.ep_possible[1]) if self.ep_possible else 0
+        bb = self.pieces[color + "P"]
+        while bb:
+            sq = (bb & -bb).bit_length() - 1
+            bb &= bb - 1
+
+            # Single and double pushes.
+            targets = 0
+            if not occupied >> (sq + step) & 1:
+                targets = 1 << (sq + step)
+                if sq >> 3 == start_row and not occupied >> (sq + 2 * step) & 1:
+                    targets |= 1 << (sq + 2 * step)
+
+            # Captures.
+            targets |= attacks[sq] & enemies
+            targets &= evasion
+            if sq in pins:
+                targets &= pins[sq]
+            self.add_pawn_moves(sq, targets, moves)
+
+            if attacks[sq] & ep_bit:
+                captured_sq = (sq & 56) | self.ep_possible[1]
+
+                # En passant can resolve a check either by capturing the checking pawn or by blocking.
+                if not evasion & (ep_bit | 1 << captured_sq):
+                    continue
+
+                # Takes both pawns off the board and checks whether the king is exposed to a slider.
+                after = occupied ^ (1 << sq) ^ (1 << captured_sq) | ep_bit
+                if rook_attacks(king_sq, after) & (self.pieces[enemy + "R"] | self.pieces[enemy + "Q"]):
+                    continue
+                if bishop_attacks(king_sq, after) & (self.pieces[enemy + "B"] | self.pieces[enemy + "Q"]):
+                    continue
+                moves.append(sq | (ep_bit.bit_length() - 1) << 6 | FLAG_EP << 12)
+
+
+    def pins(self, king_sq, color, enemy, occupied):
+        '''Returns a dict mapping the square of each pinned piece to the squares it may still move to:
+        those between the king and the pinner, plus the pinner itself.
+        '''
+
+        pins = {}
+        snipers = ((ROOK_MASKS[king_sq] & (self.pieces[enemy + "R"] | self.pieces[enemy + "Q"])) |
+                   (BISHOP_MASKS[king_sq] & (self.pieces[enemy + "B"] | self.pieces[enemy + "Q"])))
+        while snipers:
+            sniper = snipers & -snipers
+            snipers ^= sniper
+            between = BETWEEN[king_sq][sniper.bit_length() - 1]
+            blockers = between & occupied
+
+            # Exactly one allied piece between the king and the slider is a pin.
+            if blockers and blockers & (blockers - 1) == 0 and blockers & self.occupancy[color]:
+                pins[blockers.bit_length() - 1] = between | sniper
+        return pins
+
+
+    def attackers_to(self, sq, color, occupied):
+        '''Returns a bitboard with the pieces of the given colour that attack sq.
+        '''
+
+        enemy = "b" if color == "w" else "w"
+        pieces = self.pieces
+        return ((PAWN_ATTACKS[enemy][sq] & pieces[color + "P"]) |
+                (KNIGHT_ATTACKS[sq] & pieces[color + "N"]) |
+                (KING_ATTACKS[sq] & pieces[color + "K"]) |
+                (rook_attacks(sq, occupied) & (pieces[color + "R"] | pieces[color + "Q"])) |
+                (bishop_attacks(sq, occupied) & (pieces[color + "B"] | pieces[color + "Q"])))
+
+
+    def generate_legal_moves(self, quiets=True):
+        '''Yields the valid moves in the position as packed int codes, in stages: first captures
+        and promotions, then quiet moves, then castling. Pins and checkers are found once, when
+        the first move is asked for, but the king's moves are checked one by one, so a caller that
+        stops early (e. g. legal_captures) never computes the opponent's whole attack map.
+        If quiets is False, only the first stage is generated.
+        '''
+
+        color, enemy = ("w", "b") if self.w_to_move else ("b", "w")
+        pieces = self.pieces
+        own = self.occupancy[color]
+        enemies = self.occupancy[enemy]
+        occupied = own | enemies
+        king = pieces[color + "K"]
+        king_sq = king.bit_length() - 1
+        checkers = self.attackers_to(king_sq, enemy, occupied)
+        double_check = checkers & (checkers - 1)
+        if checkers:
+            evasion = checkers | BETWEEN[king_sq][checkers.bit_length() - 1]
         else:
-            self.castling(self.b_king_coord[0], self.b_king_coord[1], moves)
-        self.ep_possible = temp_ep_possible
-        self.current_castling_rights = temp_castle_rights
-        return moves
-    
-    
+            evasion = ALL_SQUARES
+        pins = {} if double_check else self.pins(king_sq, color, enemy, occupied)
+        step, start_row, last_rows = (-8, 6, 0xFF) if color == "w" else (8, 1, 0xFF << 56)
+        ep_bit = 1 << (self.ep_possible[0] * 8 + self.ep_possible[1]) if self.ep_possible else 0
+
+        stages = [enemies, ~occupied & ALL_SQUARES] if quiets else [enemies]
+        for stage, mask in enumerate(stages):
+
+            # The king can't step onto an attacked square, even one "behind" itself on a checking ray.
+            targets = KING_ATTACKS[king_sq] & mask
+            while targets:
+                target = (targets & -targets).bit_length() - 1
+                targets &= targets - 1
+                if not self.is_attacked(target, enemy, occupied ^ king):
+                    yield king_sq | target << 6
+
+            # In double check, only the king can move.
+            if double_check:
+                continue
+
+            bb = pieces[color + "P"]
+            while bb:
+                sq = (bb & -bb).bit_length() - 1
+                bb &= bb - 1
+                pushes = 0
+                if not occupied >> (sq + step) & 1:
+                    pushes = 1 << (sq + step)
+                    if sq >> 3 == start_row and not occupied >> (sq + 2 * step) & 1:
+                        pushes |= 1 << (sq + 2 * step)
+
+                # Captures and promotions first, the other pushes with the quiet moves.
+                if stage == 0:
+                    targets = (PAWN_ATTACKS[color][sq] & enemies | pushes & last_rows) & evasion
+                else:
+                    targets = pushes & ~last_rows & evasion
+                if sq in pins:
+                    targets &= pins[sq]
+                while targets:
+                    target = (targets & -targets).bit_length() - 1
+                    targets &= targets - 1
+                    if 1 << target & last_rows:
+                        for flag in range(FLAG_PROMOTION, FLAG_PROMOTION + 4):
+                            yield sq | target << 6 | flag << 12
+                    else:
+                        yield sq | target << 6
+
+                # En passant is verified like in pawn_legal_moves.
+                if stage == 0 and PAWN_ATTACKS[color][sq] & ep_bit:
+                    captured_sq = (sq & 56) | self.ep_possible[1]
+                    after = occupied ^ (1 << sq) ^ (1 << captured_sq) | ep_bit
+                    if (evasion & (ep_bit | 1 << captured_sq) and
+                            not rook_attacks(king_sq, after) & (pieces[enemy + "R"] | pieces[enemy + "Q"]) and
+                            not bishop_attacks(king_sq, after) & (pieces[enemy + "B"] | pieces[enemy + "Q"])):
+                        yield sq | (ep_bit.bit_length() - 1) << 6 | FLAG_EP << 12
+
+            for piece in "NBRQ":
+                bb = pieces[color + piece]
+                while bb:
+                    sq = (bb & -bb).bit_length() - 1
+                    bb &= bb - 1
+                    if piece == "N":
+                        targets = KNIGHT_ATTACKS[sq]
+                    elif piece == "B":
+                        targets = bishop_attacks(sq, occupied)
+                    elif piece == "R":
+                        targets = rook_attacks(sq, occupied)
+                    else:
+                        targets = bishop_attacks(sq, occupied) | rook_attacks(sq, occupied)
+                    targets &= mask & evasion
+                    if sq in pins:
+                        targets &= pins[sq]
+                    while targets:
+                        target = targets & -targets
+                        targets ^= target
+                        yield sq | (target.bit_length() - 1) << 6
+
+        # Castling last: the king can't castle out of, through or into check.
+        if quiets and not checkers:
+            rights = self.castling_rights
+            if rights & (WKS if color == "w" else BKS):
+                path = 1 << (king_sq + 1) | 1 << (king_sq + 2)
+                if (not path & occupied and not self.is_attacked(king_sq + 1, enemy) and
+                        not self.is_attacked(king_sq + 2, enemy)):
+                    yield king_sq | (king_sq + 2) << 6 | FLAG_CASTLE << 12
+            if rights & (WQS if color == "w" else BQS):
+                path = 1 << (king_sq - 1) | 1 << (king_sq - 2) | 1 << (king_sq - 3)
+                if (not path & occupied and not self.is_attacked(king_sq - 1, enemy) and
+                        not self.is_attacked(king_sq - 2, enemy)):
+                    yield king_sq | (king_sq - 2) << 6 | FLAG_CASTLE << 12
+
+
+    def legal_captures(self):
+        '''Returns the valid captures (including en passant) and promotions as packed int codes,
+        without generating the quiet moves.
+        '''
+
+        return list(self.generate_legal_moves(quiets=False))
+
+
+    def repetitions(self):
+        '''Returns how many times the current position appeared before in the game, comparing Zobrist keys.
+        Positions from before the last capture or pawn move can't come back, and the same player has to
+        be to move, so only every other position within the halfmove clock is looked at.
+        '''
+
+        log = self.undo_log
+        key = self.zobrist_key
+        count = 0
+        for i in range(len(log) - 2, max(len(log) - self.halfmove_clock, 0) - 1, -2):
+            if log[i][4] == key:
+                count += 1
+        return count
+
+
+    def is_threefold_repetition(self):
+        '''Returns True if the current position appeared at least three times.
+        '''
+
+        return self.repetitions() >= 2
+
+
+    def is_fifty_move_draw(self):
+        '''Returns True if fifty moves (one hundred halfmoves) were played without captures or pawn moves.
+        '''
+
+        return self.halfmove_clock >= 100
+
+
     def undo_move(self):
+        '''Takes back the last move in the move log, restoring the pieces, and then the castling rights,
+        en passant, halfmove clock and Zobrist key saved in the undo log.
+        '''
+
         if len(self.move_log) != 0:
             move = self.move_log.pop()
-            self.board[move.start_row][move.start_col] = move.piece_moved
-            self.board[move.target_row][move.target_col] = move.piece_captured
+            code = move if type(move) is int else move.code
+            start = code & 63
+            target = code >> 6 & 63
+            flag = code >> 12
+            captured, self.castling_rights, self.ep_possible, self.halfmove_clock, key = self.undo_log.pop()
+
+            # Puts the moved piece (a pawn, if it promoted) back on its start square,
+            # and then puts back whatever it captured.
+            piece = self.remove_piece(target)
+            if flag >= FLAG_PROMOTION:
+                piece = piece[0] + "P"
+            self.put_piece(piece, start)
+            if flag == FLAG_EP:
+                self.put_piece(captured, (start & 56) | (target & 7))
+            elif captured != "--":
+                self.put_piece(captured, target)
             self.w_to_move = not self.w_to_move
-            if move.piece_moved == "wK":
-                self.w_king_coord[0] = move.start_row
-                self.w_king_coord[1] = move.start_col
-            elif move.piece_moved == "bK":
-                self.b_king_coord[0] = move.start_row
-                self.b_king_coord[1] = move.start_col
-            if move.is_ep:
-                self.board[move.target_row][move.target_col] = "--"
-                self.board[move.start_row][move.target_col] = move.piece_captured
-                self.ep_possible = (move.target_row, move.target_col)
-            if move.piece_moved[1] == "P" and abs(move.start_row - move.target_row) == 2:
-                self.ep_possible = ()
-            self.castling_rights_log.pop()
-            new_rights = self.castling_rights_log[-1]
-            self.current_castling_right = CastleRights(new_rights.wks, new_rights.bks, new_rights.wqs, new_rights.bqs)
-            if move.is_castle:
-                if move.target_col - move.start_col == 2:
-                    self.board[move.target_row][move.target_col + 1] = self.board[move.target_row][move.target_col - 1]
-                    self.board[move.target_row][move.target_col - 1] = "--"
+            if flag == FLAG_CASTLE:
+                if target - start == 2:
+                    self.put_piece(self.remove_piece(target - 1), target + 1)
                 else:
-                    self.board[move.target_row][move.target_col - 2] = self.board[move.target_row][move.target_col + 1]
-                    self.board[move.target_row][move.target_col + 1] = "--"
+                    self.put_piece(self.remove_piece(target + 1), target - 2)
+            self.zobrist_key = key
             self.checkmate = False
             self.stalemate = False
 
 
     def possible_moves(self):
-        '''Generates all possible moves in the position by checking whose turn it is and returning all move functions.
-        Note that by possible, I mean all the moves that disregard any checks or pins.
+        '''Generates all possible moves in the position (as packed int codes) by running the move function
+        of every piece of the player to move. Note that by possible, I mean all the moves that disregard any checks or pins.
         '''
 
         moves = []
-        for r in range(len(self.board)):
-            for c in range(len(self.board[r])):
-                # Only account for the move functions of the current player.
-                turn = self.board[r][c][0]
-                if (turn == "w" and self.w_to_move) or (turn == "b" and not self.w_to_move):
-                    piece = self.board[r][c][1]
-                    self.move_functions[piece](r, c, moves)
+        color = "w" if self.w_to_move else "b"
+        for piece, function in self.move_functions.items():
+            # Only visits the squares occupied by this kind of piece.
+            bb = self.pieces[color + piece]
+            while bb:
+                sq = (bb & -bb).bit_length() - 1
+                bb &= bb - 1
+                function(sq >> 3, sq & 7, moves)
         return moves
 
 
-    def pawn_moves(self, r, c, moves):
-        '''Generates all possible pawn moves in the position by checking
-        for empty squares in front and enemy pieces on the diagonals of the pawns.
+    def add_moves(self, sq, targets, moves):
+        '''Appends a move from sq to every square set in the targets bitboard.
         '''
 
-        # White's pawn moves.
-        if self.w_to_move:
+        while targets:
+            target = targets & -targets
+            targets ^= target
+            moves.append(sq | (target.bit_length() - 1) << 6)
 
-            # Checks if square in front is empty, then appends that square to its possible moves.
-            if self.is_empty(r - 1, c):
-                moves.append(Move((r, c), (r - 1, c), self.board))
 
-                # If the pawn still hasn't moved, it can advance two squares.
-                if r == 6 and self.is_empty(r - 2, c):
-                    moves.append(Move((r, c), (r - 2, c), self.board))
+    def add_pawn_moves(self, sq, targets, moves):
+        '''Same as add_moves, but a pawn reaching the last rank gets one move for each promotion piece.
+        '''
 
-            # Creates list with the 3 squares in front.
-            front_sq = [[r - 1, c + i] for i in range(-1, 2)]
+        while targets:
+            target = (targets & -targets).bit_length() - 1
+            targets &= targets - 1
+            if target < 8 or target > 55:
+                for flag in range(FLAG_PROMOTION, FLAG_PROMOTION + 4):
+                    moves.append(sq | target << 6 | flag << 12)
+            else:
+                moves.append(sq | target << 6)
 
-            # Looks for captures.
-            self.front_squares(r, c, front_sq, moves)
 
-        # Black's pawn moves.
-        # Notice how we are now adding to the rows.
+    def pawn_moves(self, r, c, moves):
+        '''Generates all possible pawn moves in the position by checking
+        for empty squares in front and enemy pieces on the diagonals of the pawns.
+        '''
+
+        sq = r * 8 + c
+        empty = ~(self.occupancy["w"] | self.occupancy["b"])
+
+        # White's pawns move up the board (towards lower indices), black's move down.
+        if self.w_to_move:
+            color, enemy, step, start_row = "w", "b", -8, 6
         else:
-            if self.is_empty(r + 1, c):
-                moves.append(Move((r, c), (r + 1, c), self.board))
-                if r == 1 and self.is_empty(r + 2, c):
-                    moves.append(Move((r, c), (r + 2, c), self.board))
-            front_sq = [[r + 1, c + i] for i in range(-1, 2)]
-            self.front_squares(r, c, front_sq, moves)
+            color, enemy, step, start_row = "b", "w", 8, 1
+
+        # Checks if square in front is empty. If the pawn still hasn't moved, it can advance two squares.
+        targets = 0
+        if empty >> (sq + step) & 1:
+            targets = 1 << (sq + step)
+            if r == start_row and empty >> (sq + 2 * step) & 1:
+                targets |= 1 << (sq + 2 * step)
+
+        # Looks for captures on the diagonals.
+        attacks = PAWN_ATTACKS[color][sq]
+        self.add_pawn_moves(sq, targets | attacks & self.occupancy[enemy], moves)
+        if self.ep_possible and attacks >> (self.ep_possible[0] * 8 + self.ep_possible[1]) & 1:
+            moves.append(sq | (self.ep_possible[0] * 8 + self.ep_possible[1]) << 6 | FLAG_EP << 12)
 
 
     def rook_moves(self, r, c, moves):
-        '''Generates all possible rook moves by checking for empty square or enemy pieces on the files.
-        '''
-
-        # This list represents the "cross" the rook can move in.
-        files = [[[r + i, c] for i in range(1, 8 - r)],
-                 [[r - i, c] for i in range(1, r + 1)],
-                 [[r, c + i] for i in range(1, 8 - c)],
-                 [[r, c - i] for i in range(1, c + 1)]]
-
-        # Iterates through the files.
-        for direction in files:
-            for coordinates in direction:
-
-                # Checks if rook is inside the board's boundaries.
-                if self.on_board(coordinates[0], coordinates[1]):
-
-                    # Appends the move if the target square is empty or an enemy piece.
-                    if self.is_empty(coordinates[0], coordinates[1]):
-                        moves.append(
-                            Move((r, c), (coordinates[0], coordinates[1]), self.board))
-                    elif not self.team(coordinates[0], coordinates[1]):
-                        moves.append(
-                            Move((r, c), (coordinates[0], coordinates[1]), self.board))
-                        break
-                    else:
-                        break
-                else:
-                    break
+        '''Generates all possible rook moves by looking up the squares attacked along the files and ranks,
+        and dropping those occupied by allied pieces.
+        '''
+
+        own = self.occupancy["w" if self.w_to_move else "b"]
+        targets = rook_attacks(r * 8 + c, self.occupancy["w"] | self.occupancy["b"]) & ~own
+        self.add_moves(r * 8 + c, targets, moves)
 
 
     def knight_moves(self, r, c, moves):
-        '''Generates all possible knight moves by checking for a triangle with sides of length 1, 2, and sqrt(5),
-        and then looks if they are empty or occupied by enemy pieces.
+        '''Generates all possible knight moves from the precomputed knight attack masks.
         '''
-        for i in range(-2, 3):
-            for j in range(-2, 3):
-                if i ** 2 + j ** 2 == 5:  # Pythagorean theorem.
-                    if self.on_board(r + i, c + j) == True:
-                        if self.is_empty(r + i, c + j):
-                            moves.append(
-                                Move((r, c), (r + i, c + j), self.board))
-                        elif not self.team(r + i, c + j):
-                            moves.append(
-                                Move((r, c), (r + i, c + j), self.board))
+
+        own = self.occupancy["w" if self.w_to_move else "b"]
+        self.add_moves(r * 8 + c, KNIGHT_ATTACKS[r * 8 + c] & ~own, moves)
 
 
     def bishop_moves(self, r, c, moves):
         '''Generates all possible bishop moves similarly to the rook, but diagonally.
         '''
 
-        # This list represents all four diagonals the bishop can move in.
-        diagonals = [
-            [[r + i, c + i] for i in range(1, 8)],
-            [[r + i, c - i] for i in range(1, 8)],
-            [[r - i, c + i] for i in range(1, 8)],
-            [[r - i, c - i] for i in range(1, 8)],
-        ]
-
-        for direction in diagonals:
-            for coordinates in direction:
-                if self.on_board(coordinates[0], coordinates[1]):
-                    if self.is_empty(coordinates[0], coordinates[1]):
-                        moves.append(
-                            Move((r, c), (coordinates[0], coordinates[1]), self.board))
-                    elif not self.team(coordinates[0], coordinates[1]):
-                        moves.append(
-                            Move((r, c), (coordinates[0], coordinates[1]), self.board))
-                        break
-                    else:
-                        break
-                else:
-                    break
+        own = self.occupancy["w" if self.w_to_move else "b"]
+        targets = bishop_attacks(r * 8 + c, self.occupancy["w"] | self.occupancy["b"]) & ~own
+        self.add_moves(r * 8 + c, targets, moves)
 
 
     def queen_moves(self, r, c, moves):
@@ -313,162 +932,157 @@ class GameState():
 
 
     def king_moves(self, r, c, moves):
-        '''Generates all king moves by looking for empty squares and enemy pieces on the 3x3 square surrounding the king.
+        '''Generates all king moves from the precomputed mask of the 3x3 square surrounding the king.
         '''
-        for i in range(3):
-            for j in range(3):
-                if self.on_board(r - 1 + i, c - 1 + j):
-                    if self.is_empty(r - 1 + i, c - 1 + j) or not self.team(r - 1 + i, c - 1 + j):
-                        moves.append(
-                            Move((r, c), (r - 1 + i, c - 1 + j), self.board))
+
+        own = self.occupancy["w" if self.w_to_move else "b"]
+        self.add_moves(r * 8 + c, KING_ATTACKS[r * 8 + c] & ~own, moves)
 
 
     def team(self, r, c):
         '''This method returns True if the given square has a ally piece on it.
         If it's empty or occupied by an enemy piece, it returns False.
         '''
-        team_color = "w" if self.w_to_move else "b"
-        return True if self.board[r][c][0] == team_color else False
+        return bool(self.occupancy["w" if self.w_to_move else "b"] >> (r * 8 + c) & 1)
 
 
     def is_empty(self, r, c):
         '''This method returns True if the given square is empty"
         '''
-        return True if self.board[r][c] == "--" else False
+        return not (self.occupancy["w"] | self.occupancy["b"]) >> (r * 8 + c) & 1
 
 
     def on_board(self, r, c):
         '''Returns True if the given square is within the board's boundaries.
         '''
-        return True if (r in range(0, 8) and c in range(0, 8)) else False
+        return 0 <= r < 8 and 0 <= c < 8
 
 
     def in_check(self):
         '''Returns True if the king is in check, else, False.
         '''
         if self.w_to_move:
-            return self.square_under_attack(self.w_king_coord[0], self.w_king_coord[1])
+            return self.is_attacked(self.pieces["wK"].bit_length() - 1, "b")
         else:
-            return self.square_under_attack(self.b_king_coord[0], self.b_king_coord[1])
+            return self.is_attacked(self.pieces["bK"].bit_length() - 1, "w")
 
 
     def square_under_attack(self, r, c):
-        '''Checks if the given square is under attack by switching turns temporarily
-        and calculating the opponent's possible moves.
+        '''Checks if the given square is attacked by the opponent of the player to move.
         '''
 
-        # Switches turns
-        self.w_to_move = not self.w_to_move
+        return self.is_attacked(r * 8 + c, "b" if self.w_to_move else "w")
 
-        # Generates all opponent's moves
-        opp_moves = self.possible_moves()
 
-        # Switches turns back
-        self.w_to_move = not self.w_to_move
+    def is_attacked(self, sq, color, occupied=None):
+        '''Returns True if any piece of the given colour attacks sq. Instead of generating the
+        opponent's moves, it looks outward from sq: a knight (or pawn, or king) attacks sq
+        if it stands on a square a knight on sq would attack, and a slider attacks sq if it's
+        the first piece hit along one of the rays. It returns as soon as an attacker is found.
+        The sliders' rays stop at the occupied squares, which default to the board's.
+        '''
 
-        # If any opp. moves' coordinates match that of the given square, return True.
-        # Else, return false.
-        for move in opp_moves:
-            if move.target_row == r and move.target_col == c:
-                return True
+        pieces = self.pieces
+        if KNIGHT_ATTACKS[sq] & pieces[color + "N"]:
+            return True
+        if PAWN_ATTACKS["b" if color == "w" else "w"][sq] & pieces[color + "P"]:
+            return True
+        if KING_ATTACKS[sq] & pieces[color + "K"]:
+            return True
+        if occupied is None:
+            occupied = self.occupancy["w"] | self.occupancy["b"]
+        rooks = pieces[color + "R"] | pieces[color + "Q"]
+        if rooks and rook_attacks(sq, occupied) & rooks:
+            return True
+        bishops = pieces[color + "B"] | pieces[color + "Q"]
+        if bishops and bishop_attacks(sq, occupied) & bishops:
+            return True
         return False
 
 
-    def front_squares(self, r, c, front_sq, moves):
-        '''Looks for possible pawn captures in the three squares in front of the pawn
-        (left diagonal, directly in front, right diagonal).
+    def attacked_squares(self, white):
+        '''Returns the set of (row, col) squares attacked by white (or black, if white is False),
+        computed in one pass over that side's pieces.
         '''
 
-        for coordinates in front_sq:
-            # Only evaluates to True for the squares diagonal to the pawn.
-            if self.on_board(coordinates[0], coordinates[1]) and front_sq.index(coordinates) % 2 == 0:
-                if not self.team(coordinates[0], coordinates[1]) and not self.is_empty(coordinates[0], coordinates[1]):
-                    moves.append(
-                        Move((r, c), (coordinates[0], coordinates[1]), self.board))
-                elif (coordinates[0], coordinates[1]) == self.ep_possible:
-                    moves.append(
-                        Move((r, c), (coordinates[0], coordinates[1]), self.board, is_ep=True))
+        attacks = self.attack_map("w" if white else "b")
+        squares = set()
+        while attacks:
+            sq = (attacks & -attacks).bit_length() - 1
+            attacks &= attacks - 1
+            squares.add((sq >> 3, sq & 7))
+        return squares
 
 
-    def castling(self, r, c, moves):
-        '''Gets all castling moves in the position by checking if the square is under
-        attack and calling a function for kingside and another for queenside castling
+    def attack_map(self, color, occupied=None):
+        '''Returns a bitboard with every square attacked by the pieces of the given colour.
+        The sliding pieces' rays stop at the occupied squares, which default to the board's.
         '''
 
-        if self.square_under_attack(r, c):
-            return
+        if occupied is None:
+            occupied = self.occupancy["w"] | self.occupancy["b"]
+        attacks = 0
+        for piece, table in (("P", PAWN_ATTACKS[color]), ("N", KNIGHT_ATTACKS), ("K", KING_ATTACKS)):
+            bb = self.pieces[color + piece]
+            while bb:
+                sq = (bb & -bb).bit_length() - 1
+                bb &= bb - 1
+                attacks |= table[sq]
+        bb = self.pieces[color + "R"] | self.pieces[color + "Q"]
+        while bb:
+            sq = (bb & -bb).bit_length() - 1
+            bb &= bb - 1
+            attacks |= rook_attacks(sq, occupied)
+        bb = self.pieces[color + "B"] | self.pieces[color + "Q"]
+        while bb:
+            sq = (bb & -bb).bit_length() - 1
+            bb &= bb - 1
+            attacks |= bishop_attacks(sq, occupied)
+        return attacks
+
+
+    def castling(self, r, c, moves, danger):
+        '''Gets all castling moves in the position by calling a function for kingside and another
+        for queenside castling. danger is the bitboard of squares attacked by the opponent.
+        get_valid_moves only calls it when the king isn't in check.
+        '''
 
-        if (self.w_to_move and self.current_castling_rights.wks) or (
-                not self.w_to_move and self.current_castling_rights.bks):
-            self.kgs_castling(r, c, moves)
+        if self.castling_rights & (WKS if self.w_to_move else BKS):
+            self.kgs_castling(r, c, moves, danger)
 
-        if (self.w_to_move and self.current_castling_rights.wqs) or (
-                not self.w_to_move and self.current_castling_rights.bqs):
-            self.qs_castling(r, c, moves)
+        if self.castling_rights & (WQS if self.w_to_move else BQS):
+            self.qs_castling(r, c, moves, danger)
 
 
-    def kgs_castling(self, r, c, moves):
+    def kgs_castling(self, r, c, moves, danger):
         '''Checks for kingside castling by seeing if the two squares next to the king are empty.
-        It also makes sure the king (or these squares) are not under attack.
+        It also makes sure these squares are not under attack.
         '''
 
-        if self.is_empty(r, c + 1) and self.is_empty(r, c + 2):
-            if not self.square_under_attack(r, c + 1) and not self.square_under_attack(r, c + 2):
-                moves.append(
-                    Move((r, c), (r, c + 2), self.board, is_castle=True))
+        sq = r * 8 + c
+        path = 1 << (sq + 1) | 1 << (sq + 2)
+        if not path & (self.occupancy["w"] | self.occupancy["b"]) and not path & danger:
+            moves.append(sq | (sq + 2) << 6 | FLAG_CASTLE << 12)
 
 
-    def qs_castling(self, r, c, moves):
+    def qs_castling(self, r, c, moves, danger):
         '''Checks for queenside castling by seeing if the three squares next to the king are empty.
-        It also makes sure the king (or these squares) are not under attack.
-        '''
-        if (self.is_empty(r, c - 1) and self.is_empty(r, c - 2) and self.is_empty(r, c - 3) and
-                not self.square_under_attack(r, c - 1) and not self.square_under_attack(r, c - 2)):  # Only the squares the king passes by cannot be under attack
-            moves.append(Move((r, c), (r, c - 2), self.board, is_castle=True))
-
-
-    def update_castle_rights(self, move):
-        '''Checks whether the king or the rook have moved (or captured, in case of the rook), 
-        then updates current castling rights.
-        '''
-
-        # If either king has moved, it cannot castle in both directions.
-        if move.piece_moved == "wK":
-            self.current_castling_rights.wks = False
-            self.current_castling_rights.wqs = False
-        elif move.piece_moved == "bK":
-            self.current_castling_rights.bks = False
-            self.current_castling_rights.bqs = False
-
-        # If the rook has moved, check which rook it is and
-        # then change current castling rights accordingly.
-        elif move.piece_moved == "wR":
-            if move.start_row == 7:
-                if move.start_col == 0:
-                    self.current_castling_rights.wqs = False
-                elif move.start_col == 7:
-                    self.current_castling_rights.wks = False
-        elif move.piece_moved == "bR":
-            if move.start_row == 0:
-                if move.start_col == 0:
-                    self.current_castling_rights.bqs = False
-                elif move.start_col == 7:
-                    self.current_castling_rights.bks = False
-
-        # Fixes bug where the king would castle with the
-        # enemy piece that captured the rook.
-        if move.piece_captured == "wR":
-            if move.target_row == 7:
-                if move.target_col == 0:
-                    self.current_castling_rights.wqs = False
-                elif move.target_col == 7:
-                    self.current_castling_rights.wks = False
-        elif move.piece_captured == "bR":
-            if move.target_row == 0:
-                if move.target_col == 0:
-                    self.current_castling_rights.bqs = False
-                elif move.target_col == 7:
-                    self.current_castling_rights.bks = False
+        It also makes sure the squares the king passes by are not under attack.
+        '''
+
+        sq = r * 8 + c
+        path = 1 << (sq - 1) | 1 << (sq - 2)
+        if not (path | 1 << (sq - 3)) & (self.occupancy["w"] | self.occupancy["b"]) and not path & danger:
+            moves.append(sq | (sq - 2) << 6 | FLAG_CASTLE << 12)
+
+
+    def update_castle_rights(self, start, target):
+        '''Checks whether the king or the rooks have moved (or a rook was captured, so the king
+        can't castle with the enemy piece that took it), then updates the castling rights.
+        start and target are square indices (see CASTLING_MASKS).
+        '''
+
+        self.castling_rights &= CASTLING_MASKS[start] & CASTLING_MASKS[target]
 
 
 class CastleRights():
@@ -487,54 +1101,86 @@ class CastleRights():
 
 
 class Move():
-    '''Handles most information about the move played.
+    '''Handles most information about the move played. GameState generates and plays moves as
+    packed int codes (see FLAG_EP above), and Move is a light wrapper around one of them with
+    the pieces involved, for the board, the animations and the move log.
     '''
 
-    # Inverts the board and changes collumns' coordinates from numerical to alphabetical.
+    __slots__ = ("code", "piece_moved", "piece_captured")
 
-    def __init__(self, start_sq, target_sq, board, is_ep=False, is_castle=False):
-        '''Initialises some instance variables used to store information about the move played
+    def __init__(self, start_sq, target_sq, board, promotion="Q"):
+        '''Initialises the move from its start and target (row, col) squares. Whether it is castle,
+        en passant or a promotion is worked out from the pieces on the board.
         '''
 
-        # Store start and target rows and collumns.
-        self.start_row = start_sq[0]
-        self.start_col = start_sq[1]
-        self.target_row = target_sq[0]
-        self.target_col = target_sq[1]
+        start = start_sq[0] * 8 + start_sq[1]
+        target = target_sq[0] * 8 + target_sq[1]
 
         # Represents the position on the board of the moved piece.
-        self.piece_moved = board[self.start_row][self.start_col]
+        self.piece_moved = board[start_sq[0]][start_sq[1]]
 
         # Stores the position on the board of the captured piece. Empty squares are also "captured".
-        self.piece_captured = board[self.target_row][self.target_col]
+        self.piece_captured = board[target_sq[0]][target_sq[1]]
+
+        # A king moving two squares is castle, a pawn moving diagonally to an empty square is
+        # en passant (which captures the pawn beside it), and a pawn reaching the last rank promotes.
+        flag = 0
+        if self.piece_moved[1] == "K" and abs(target - start) == 2:
+            flag = FLAG_CASTLE
+        elif self.piece_moved[1] == "P":
+            if start_sq[1] != target_sq[1] and self.piece_captured == "--":
+                flag = FLAG_EP
+                self.piece_captured = "wP" if self.piece_moved == "bP" else "bP"
+            elif target_sq[0] == 0 or target_sq[0] == 7:
+                flag = FLAG_PROMOTION + PROMOTION_PIECES.index(promotion)
+        self.code = start | target << 6 | flag << 12
+
+
+    @classmethod
+    def from_code(cls, code, board):
+        '''Wraps a packed move code generated by GameState, reading the pieces from the board.
+        '''
 
-        # Checks if the move is a pawn promotion by looking at the rank the pawn is at.
-        self.is_pawn_promotion = (self.piece_moved == "wP" and self.target_row == 0) or (
-            self.piece_moved == "bP" and self.target_row == 7)
+        move = cls.__new__(cls)
+        move.code = code
+        start = code & 63
+        target = code >> 6 & 63
+        move.piece_moved = board[start >> 3][start & 7]
+        if code >> 12 == FLAG_EP:
+            move.piece_captured = "wP" if move.piece_moved == "bP" else "bP"
+        else:
+            move.piece_captured = board[target >> 3][target & 7]
+        return move
 
-        # Checks if the move is en passant and captures the appropriate pawn.
-        self.is_ep = is_ep
-        if self.is_ep:
-            self.piece_captured = "wP" if self.piece_moved == "bP" else "bP"
 
-        # Stores whether the move is castle.
-        self.is_castle = is_castle
+    # The squares and flags are read from the packed code.
+    start_row = property(lambda self: (self.code & 63) >> 3)
+    start_col = property(lambda self: self.code & 7)
+    target_row = property(lambda self: (self.code >> 6 & 63) >> 3)
+    target_col = property(lambda self: self.code >> 6 & 7)
+    is_ep = property(lambda self: self.code >> 12 == FLAG_EP)
+    is_castle = property(lambda self: self.code >> 12 == FLAG_CASTLE)
+    is_pawn_promotion = property(lambda self: self.code >> 12 >= FLAG_PROMOTION)
+    promotion = property(lambda self: PROMOTION_PIECES[(self.code >> 12) - FLAG_PROMOTION]
+                         if self.code >> 12 >= FLAG_PROMOTION else None)
 
-        # This moveID is used later to differentiate between moves. This is based on
-        # the fact that, in a given position, only one piece can go from a specific square to another.
-        self.moveID = self.start_row * 1000 + self.start_col * \
-            100 + self.target_row * 10 + self.target_col
+    # Kept for code that compared moves through moveID: the packed code is unique in a position.
+    moveID = property(lambda self: self.code)
 
 
     def __eq__(self, other):
-        '''Overrides __eq__ to allow proper equivalence between moves with moveID.
+        '''Overrides __eq__ to allow proper equivalence between moves with their packed codes.
         '''
 
         if isinstance(other, Move):
-            return self.moveID == other.moveID
+            return self.code == other.code
         return False
 
 
+    def __hash__(self):
+        return self.code
+
+
     def chess_notation(self):
         '''Calls the method "convert" on the start and target rows and collumns,
         converting the move to the appropriate chess notation.
@@ -5,12 +5,10 @@ import pygame as p
 from cs50 import SQL
 from gamestate import *
 from chessboard import *
-from fen_parser import *
 from fen_writer import fen_generator
 from engine import *
 from chessboard import *
 from pgnparser import *
-import random
 import sys
 
 
@@ -56,8 +54,8 @@ def main():
     # Used to draw engine evaluation.
     eng_eval = False
 
-    # Keep track of important information for writing FEN.
-    captures, halfmove_clock, pgn_index, castle_counter, fullmove_number = 0, 0, 0, 1, 1
+    # Index of the next move of the PGN game being replayed.
+    pgn_index = 0
 
     # Input boxes. The first is used for SQL queries, the second, for FEN.
     input_box1 = Input(535, 400, 140, 32)
@@ -70,9 +68,19 @@ def main():
     # Error messages
     search_error, eng_error, eval_error, fen_error = False, False, False, False
 
+    # Runs the engine in the background, so the window keeps responding while it thinks. The engine itself
+    # is started when it's first needed, or straight away (in the background) if ENGINE_PREWARM is set.
+    analysis = AnalysisWorker()
+    if ENGINE_PREWARM:
+        prewarm()
+
     while True:
         for e in p.event.get():
             if e.type == p.QUIT:
+                # Stops any analysis and quits the engines before closing the window.
+                analysis.cancel()
+                shutdown()
+                print(cache.report())
                 p.quit()
                 sys.exit()
             elif e.type == p.MOUSEBUTTONDOWN:
@@ -113,27 +121,14 @@ def main():
                                 fen_ep = move.convert(
                                     move.start_row, move.start_col)
 
-                                # Counts the number of empty squares on the board.
-                                empty = sum(row.count('--') for row in gs.board)
-
-                                # Looks for captures and resets the halfmove clock.
-                                if empty > 32 + captures:
-                                    captures += 1
-                                    halfmove_clock = 0
-
-                                # Resets halfmove clock if the piece moved was a pawn.
-                                if move.piece_moved[1] == "P":
-                                    halfmove_clock = 0
-
-                                # Increments 1 to fullmove number.
-                                if gs.w_to_move:
-                                    fullmove_number += 1
-
                                 # Generates a FEN from the current position.
-                                fen = fen_generator(gs.board, gs.w_to_move, gs.castling_rights_log[castle_counter].wks, gs.castling_rights_log[castle_counter].wqs,
-                                                    gs.castling_rights_log[castle_counter].bks, gs.castling_rights_log[
-                                                        castle_counter].bqs, move.piece_moved,
-                                                    move.start_row, move.target_row, fen_ep[0], halfmove_clock, fullmove_number)
+                                fen = fen_generator(gs.board, gs.w_to_move, gs.current_castling_rights.wks, gs.current_castling_rights.wqs,
+                                                    gs.current_castling_rights.bks, gs.current_castling_rights.bqs, move.piece_moved,
+                                                    move.start_row, move.target_row, fen_ep[0], gs.halfmove_clock, gs.fullmove_number)
+
+                                # Any analysis of the previous position is no longer needed, unless the engine
+                                # was pondering (thinking about its reply) on the move just played.
+                                analysis.moved(fen)
 
                                 move_made = True
                                 animate = True
@@ -143,7 +138,9 @@ def main():
                         if not move_made:
                             player_clicks = [sq_selected]
 
-                    # Closes engine evaluation when player clicks on the screen.
+                    # Closes engine evaluation when player clicks on the screen, and stops it if it's still running.
+                    if eng_eval:
+                        analysis.cancel()
                     eng_eval = False
 
             elif e.type == p.KEYDOWN:
@@ -160,35 +157,15 @@ def main():
                     last_input = input_box2.input_list[-1]
 
                     try:
-                        # Reads last input.
-                        fp = FenParser(last_input)
+                        # Reads last input and sets up the board, the turn, castling rights, en passant and the move counters.
+                        # An invalid FEN leaves the board as it was.
+                        gs.load_fen(last_input)
+                        analysis.cancel()
 
-                    except:
+                    except ValueError:
                         fen_error = True
 
                     else:
-                        # Gets values in FEN's fields and assigns them to variables.
-                        castle_counter, halfmove_clock, fullmove_number, turn, fen_castle = 1, fp.halfmove_clock(
-                        ), fp.fullmove_number(), fp.turn(), fp.castle()
-
-                        # Sets up the board.
-                        gs.board = fp.parse()
-
-                        # Sums up empty squares on the board and looks for captures.
-                        empty = sum(row.count('--') for row in gs.board)
-                        captures = empty - 32
-
-                        # Handles castling rights and appends them to the castling rights log.
-                        gs.w_to_move = True if turn == "w" else False
-                        wks = True if "K" in fen_castle else False
-                        bks = True if "k" in fen_castle else False
-                        wqs = True if "Q" in fen_castle else False
-                        bqs = True if "q" in fen_castle else False
-                        gs.current_castling_rights = CastleRights(
-                            wks, bks, wqs, bqs)
-                        gs.castling_rights_log.append(CastleRights(gs.current_castling_rights.wks, gs.current_castling_rights.bks,
-                                                                   gs.current_castling_rights.wqs, gs.current_castling_rights.bqs))
-
                         # Sets FEN in the clipboard to the current FEN.
                         fen = pyperclip.paste()
 
@@ -212,24 +189,26 @@ def main():
                     else:
                         # Reads query's PGN, gets all valid moves, and resets variables.
                         pgn_moves = pgn_parser(query)
+                        analysis.cancel()
                         gs = GameState()
                         valid_moves = gs.get_valid_moves()
                         sq_selected = ()
                         player_clicks = []
                         move_made = False
                         animate = False
-                        captures, halfmove_clock, pgn_index, castle_counter, fullmove_number = 0, 0, 0, 1, 1
+                        pgn_index = 0
                 elif e.key == p.K_r:
                     '''Resets all variables.
                     '''
                     
+                    analysis.cancel()
                     gs = GameState()
                     valid_moves = gs.get_valid_moves()
                     sq_selected = ()
                     player_clicks = []
                     move_made = False
                     animate = False
-                    captures, halfmove_clock, pgn_index, castle_counter, fullmove_number = 0, 0, 0, 1, 1
+                    pgn_index = 0
                     game_over = False
                     search_error, eng_error, eval_error, eng_eval = False, False, False, False
                     query = None
@@ -237,182 +216,46 @@ def main():
                     '''Looks for best moves in the position with a low-depth engine.
                     '''
                     try:
-                        # Analyzes the position in low depth and time limit.
-                        eng_evaluation = analyze_position(
-                            fen, num_moves_to_return=3, depth_limit=3, time_limit=1)
+                        # Plays a move from the opening book, or else analyzes the position in low depth and time limit.
+                        analysis.submit("move", fen, num_moves_to_return=3, depth_limit=3, time_limit=1, use_book=True)
                     except UnboundLocalError:
                         eng_error = True
-                    else:
-                        # To avoid playing the same moves all the time, checks if the best moves are
-                        # similar in evaluation and picks one randomly. Also plays any moves that
-                        # lead to mate instantly.
-                        if eng_evaluation[0]["mate_score"] != None:
-                            eng_line = eng_evaluation[0]
-                        elif abs(eng_evaluation[2]["centipawn_score"] - eng_evaluation[0]["centipawn_score"]) < 25:
-                            eng_line = eng_evaluation[random.randint(0, 2)]
-                        elif abs(eng_evaluation[1]["centipawn_score"] - eng_evaluation[0]["centipawn_score"]) < 25:
-                            eng_line = eng_evaluation[random.randint(0, 1)]
-                        else:
-                            eng_line = eng_evaluation[0]
-                        eng_interpret = eng_interpreter(eng_line)
-
-                        # Makes the engine's move.
-                        move = Move(eng_interpret[0],eng_interpret[1], gs.board)
-                        for i in range(len(valid_moves)):
-                            if move == valid_moves[i]:
-                                gs.make_move(valid_moves[i])
-                                fen_ep = move.convert(
-                                    move.start_row, move.start_col)
-                                empty = sum(row.count('--')
-                                            for row in gs.board)
-                                if empty > 32 + captures:
-                                    captures += 1
-                                    halfmove_clock = 0
-                                if move.piece_moved[1] == "P":
-                                    halfmove_clock = 0
-                                if gs.w_to_move:
-                                    fullmove_number += 1
-                                if len(gs.move_log) != 0:
-                                    fen = fen_generator(gs.board, gs.w_to_move, gs.castling_rights_log[castle_counter].wks, gs.castling_rights_log[castle_counter].wqs,
-                                                        gs.castling_rights_log[castle_counter].bks, gs.castling_rights_log[
-                                                            castle_counter].bqs, move.piece_moved,
-                                                        move.start_row, move.target_row, fen_ep[0], halfmove_clock, fullmove_number)
-                                move_made = True
-                                animate = True
                 elif e.key == p.K_2 and p.key.get_mods() & p.KMOD_SHIFT:
                     '''Looks for best moves in the position with a mid-depth engine.
                     '''
                     try:
-                        # Analyzes the position in mid depth and time limit.
-                        eng_evaluation = analyze_position(
-                            fen, num_moves_to_return=3, depth_limit=10, time_limit=3)
+                        # Plays a move from the opening book, or else analyzes the position in mid depth and time limit.
+                        analysis.submit("move", fen, num_moves_to_return=3, depth_limit=10, time_limit=3, use_book=True)
                     except UnboundLocalError:
                         eng_error = True
-                    else:
-                        # To avoid playing the same moves all the time, checks if the best moves are
-                        # similar in evaluation and picks one randomly. Also plays any moves that
-                        # lead to mate instantly.
-                        if eng_evaluation[0]["mate_score"] != None:
-                            eng_line = eng_evaluation[0]
-                        elif abs(eng_evaluation[2]["centipawn_score"] - eng_evaluation[0]["centipawn_score"]) < 25:
-                            eng_line = eng_evaluation[random.randint(0, 2)]
-                        elif abs(eng_evaluation[1]["centipawn_score"] - eng_evaluation[0]["centipawn_score"]) < 25:
-                            eng_line = eng_evaluation[random.randint(0, 1)]
-                        else:
-                            eng_line = eng_evaluation[0]
-
-                        # Makes the engine's move.
-                        move = Move(eng_interpret[0], eng_interpret[1], gs.board)
-                        for i in range(len(valid_moves)):
-                            if move == valid_moves[i]:
-                                gs.make_move(valid_moves[i])
-                                fen_ep = move.convert(
-                                    move.start_row, move.start_col)
-                                empty = sum(row.count('--')
-                                            for row in gs.board)
-                                if empty > 32 + captures:
-                                    captures += 1
-                                    halfmove_clock = 0
-                                if move.piece_moved[1] == "P":
-                                    halfmove_clock = 0
-                                if gs.w_to_move:
-                                    fullmove_number += 1
-                                if len(gs.move_log) != 0:
-                                    fen = fen_generator(gs.board, gs.w_to_move, gs.castling_rights_log[castle_counter].wks, gs.castling_rights_log[castle_counter].wqs,
-                                                        gs.castling_rights_log[castle_counter].bks, gs.castling_rights_log[
-                                                            castle_counter].bqs, move.piece_moved,
-                                                        move.start_row, move.target_row, fen_ep[0], halfmove_clock, fullmove_number)
-                                move_made = True
-                                animate = True
                 elif e.key == p.K_3 and p.key.get_mods() & p.KMOD_SHIFT:
                     '''Looks for best moves in the position with a high-depth engine.
                     '''
                     try:
-                        # Analyzes the position in low depth and time limit.
-                        eng_evaluation = analyze_position(
-                            fen, num_moves_to_return=3, depth_limit=22, time_limit=10)
+                        # Plays a move from the opening book, or else analyzes the position in high depth and time limit.
+                        analysis.submit("move", fen, num_moves_to_return=3, depth_limit=22, time_limit=10, use_book=True)
                     except UnboundLocalError:
                         eng_error = True
-                    else:
-                        # To avoid playing the same moves all the time, checks if the best moves are
-                        # similar in evaluation and picks one randomly. Also plays any moves that
-                        # lead to mate instantly.
-                        if eng_evaluation[0]["mate_score"] != None:
-                            eng_line = eng_evaluation[0]
-                        elif abs(eng_evaluation[2]["centipawn_score"] - eng_evaluation[0]["centipawn_score"]) < 25:
-                            eng_line = eng_evaluation[random.randint(0, 2)]
-                        elif abs(eng_evaluation[1]["centipawn_score"] - eng_evaluation[0]["centipawn_score"]) < 25:
-                            eng_line = eng_evaluation[random.randint(0, 1)]
-                        else:
-                            eng_line = eng_evaluation[0]
-                        eng_interpret = eng_interpreter(eng_line)
-
-                        # Makes the engine's move.
-                        move = Move(eng_interpret[0], eng_interpret[1], gs.board)
-                        for i in range(len(valid_moves)):
-                            if move == valid_moves[i]:
-                                gs.make_move(valid_moves[i])
-                                fen_ep = move.convert(
-                                    move.start_row, move.start_col)
-                                empty = sum(row.count('--')
-                                            for row in gs.board)
-                                if empty > 32 + captures:
-                                    captures += 1
-                                    halfmove_clock = 0
-                                if move.piece_moved[1] == "P":
-                                    halfmove_clock = 0
-                                if gs.w_to_move:
-                                    fullmove_number += 1
-                                if len(gs.move_log) != 0:
-                                    fen = fen_generator(gs.board, gs.w_to_move, gs.castling_rights_log[castle_counter].wks, gs.castling_rights_log[castle_counter].wqs,
-                                                        gs.castling_rights_log[castle_counter].bks, gs.castling_rights_log[
-                                                            castle_counter].bqs, move.piece_moved,
-                                                        move.start_row, move.target_row, fen_ep[0], halfmove_clock, fullmove_number)
-                                move_made = True
-                                animate = True
                 elif e.key == p.K_4 and p.key.get_mods() & p.KMOD_SHIFT:
-                    '''Evaluates the position on the board with a mid depth engine.
+                    '''Evaluates the position on the board with a mid depth engine, showing the evaluation as it improves.
                     '''
                     try:
-                        eng_evaluation = analyze_position(
-                            fen, num_moves_to_return=1, depth_limit=22, time_limit=5)
+                        analysis.submit("eval", fen, num_moves_to_return=1, depth_limit=22, time_limit=5, stream=True)
                     except UnboundLocalError:
                         eval_error = True
                     else:
-                        if eng_evaluation[0]["mate_score"] != None and gs.w_to_move:
-                            score = "White has mate in " + \
-                                str(eng_evaluation[0]["mate_score"] +
-                                    " (" + str(eng_evaluation[0]["pv"][0]) + ")")
-                        elif eng_evaluation[0]["mate_score"] != None and not gs.w_to_move:
-                            score = "Black has mate in " + \
-                                str(eng_evaluation[0]["mate_score"]) + \
-                                " (" + str(eng_evaluation[0]["pv"][0]) + ")"
-                        else:
-                            score = str(eng_evaluation[0]["centipawn_score"]) + \
-                                " centipawns (" + \
-                                str(eng_evaluation[0]["pv"][0]) + ")"
+                        score = "Thinking..."
                         eng_eval = True
                 elif e.key == p.K_5 and p.key.get_mods() & p.KMOD_SHIFT:
-                    '''Evaluates the position on the board with a high depth engine.
+                    '''Evaluates the position on the board without limits, showing the evaluation as it improves,
+                    until a move is made or the player clicks on the screen.
                     '''
                     try:
-                        eng_evaluation = analyze_position(
-                            fen, num_moves_to_return=1, depth_limit=22, time_limit=10)
+                        analysis.submit("eval", fen, num_moves_to_return=1, stream=True)
                     except UnboundLocalError:
                         eval_error = True
                     else:
-                        if eng_evaluation[0]["mate_score"] != None and gs.w_to_move:
-                            score = "White has mate in " + \
-                                str(eng_evaluation[0]["mate_score"] +
-                                    " (" + str(eng_evaluation[0]["pv"][0]) + ")")
-                        elif eng_evaluation[0]["mate_score"] != None and not gs.w_to_move:
-                            score = "Black has mate in " + \
-                                str(eng_evaluation[0]["mate_score"]) + \
-                                " (" + str(eng_evaluation[0]["pv"][0]) + ")"
-                        else:
-                            score = str(eng_evaluation[0]["centipawn_score"]) + \
-                                " centipawns (" + \
-                                str(eng_evaluation[0]["pv"][0]) + ")"
+                        score = "Thinking..."
                         eng_eval = True
                 elif e.key == p.K_RIGHT:
                     '''Iterates through PGN string and makes the moves.
@@ -424,33 +267,58 @@ def main():
                         for i in range(len(valid_moves)):
                             if move == valid_moves[i]:
                                 gs.make_move(valid_moves[i])
+                                analysis.cancel()
                                 fen_ep = move.convert(
                                     move.start_row, move.start_col)
-                                empty = sum(row.count('--')
-                                            for row in gs.board)
-                                if empty > 32 + captures:
-                                    captures += 1
-                                    halfmove_clock = 0
-                                if move.piece_moved[1] == "P":
-                                    halfmove_clock = 0
-                                if gs.w_to_move:
-                                    fullmove_number += 1
                                 if len(gs.move_log) != 0:
-                                    fen = fen_generator(gs.board, gs.w_to_move, gs.castling_rights_log[castle_counter].wks, gs.castling_rights_log[castle_counter].wqs,
-                                                        gs.castling_rights_log[castle_counter].bks, gs.castling_rights_log[
-                                                            castle_counter].bqs, move.piece_moved,
-                                                        move.start_row, move.target_row, fen_ep[0], halfmove_clock, fullmove_number)
+                                    fen = fen_generator(gs.board, gs.w_to_move, gs.current_castling_rights.wks, gs.current_castling_rights.wqs,
+                                                        gs.current_castling_rights.bks, gs.current_castling_rights.bqs, move.piece_moved,
+                                                        move.start_row, move.target_row, fen_ep[0], gs.halfmove_clock, gs.fullmove_number)
                                 move_made = True
                                 animate = True
                                 eng_eval = False
+        # Picks up the engine's analyses (or, for evaluations, their updates) that arrived since the last frame.
+        for tag, update in analysis.poll():
+            # None means the engine failed (e. g. it crashed and couldn't be restarted).
+            if update is None:
+                if tag == "move":
+                    eng_error = True
+                elif eng_eval:
+                    eval_error, eng_eval = True, False
+                continue
+            if not update["lines"] or not update["lines"][0]["pv"]:
+                continue
+            eng_evaluation = update["lines"]
+            if tag == "move":
+                # Makes the engine's move.
+                eng_line = choose_line(eng_evaluation)
+                eng_interpret = eng_interpreter(eng_line)
+                move = Move(eng_interpret[0], eng_interpret[1], gs.board)
+                for i in range(len(valid_moves)):
+                    if move == valid_moves[i]:
+                        gs.make_move(valid_moves[i])
+                        fen_ep = move.convert(
+                            move.start_row, move.start_col)
+                        fen = fen_generator(gs.board, gs.w_to_move, gs.current_castling_rights.wks, gs.current_castling_rights.wqs,
+                                            gs.current_castling_rights.bks, gs.current_castling_rights.bqs, move.piece_moved,
+                                            move.start_row, move.target_row, fen_ep[0], gs.halfmove_clock, gs.fullmove_number)
+                        move_made = True
+                        animate = True
+
+                        # Keeps thinking, on the player's time, about the reply the engine expects.
+                        if ENGINE_PONDER and len(eng_line["pv"]) > 1:
+                            analysis.ponder(fen, eng_line["pv"][1], num_moves_to_return=3)
+            elif tag == "eval" and eng_eval:
+                score = describe_line(eng_evaluation[0])
+                if update["depth"] is not None:
+                    score += ", depth " + str(update["depth"])
+
         if move_made:
             if animate:
                 animate_move(gs.move_log[-1], screen, gs.board, clock)
             valid_moves = gs.get_valid_moves()
             move_made = False
             animate = False
-            castle_counter += 1
-            halfmove_clock += 1
         for box in input_boxes:
             box.update()
         draw_game_state(screen, gs, valid_moves, sq_selected)
@@ -461,6 +329,9 @@ def main():
         if gs.checkmate or gs.stalemate:
             game_over = True
             draw_text(screen, "Stalemate (press r)" if gs.stalemate else "Black wins by checkmate (press r)" if gs.w_to_move else "White wins by checkmate (press r)")
+        elif gs.is_threefold_repetition() or gs.is_fifty_move_draw():
+            game_over = True
+            draw_text(screen, "Draw by repetition (press r)" if gs.is_threefold_repetition() else "Draw by the fifty-move rule (press r)")
         elif search_error:
             draw_text(screen, "Sorry, can't find your search :(  (press r)")
         elif eng_error:
@@ -471,6 +342,8 @@ def main():
             draw_text(screen, "Please, provide a valid fen")
         elif eng_eval:
             draw_text(screen, score)
+        elif analysis.is_busy():
+            draw_text(screen, "Thinking...")
 
         # Sets FPS
         clock.tick(MAX_FPS)
@@ -0,0 +1,95 @@
+'''Bounded LRU cache of legal move lists, keyed by the positions' Zobrist keys.
+Source: https://docs.python.org/3/library/collections.html#collections.OrderedDict
+'''
+
+from collections import OrderedDict
+import threading
+
+
+class MoveCache():
+    '''Stores the legal moves of recently seen positions, so positions that come up again
+    (replaying a PGN, resetting the board, common openings) don't need to be generated again.
+    A single cache can be shared by every GameState in the process: all access goes
+    through a lock, and the stored entries are immutable tuples.
+    '''
+
+    def __init__(self, max_size=4096):
+        '''max_size is the number of positions kept. When it is exceeded,
+        the least recently used position is evicted.
+        '''
+
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Counters used to see how well the cache is doing.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key):
+        '''Returns the entry stored for key and marks it as recently used, or None if it isn't cached.
+        '''
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+
+    def put(self, key, entry):
+        '''Stores an entry for key, evicting the least recently used entries if the cache is full.
+        '''
+
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.evict()
+
+
+    def resize(self, max_size):
+        '''Changes the number of positions kept, evicting entries if needed.
+        '''
+
+        with self.lock:
+            self.max_size = max_size
+            self.evict()
+
+
+    def evict(self):
+        '''Drops the least recently used entries until the cache fits. Callers must hold the lock.
+        '''
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+    def clear(self):
+        '''Empties the cache and resets its counters.
+        '''
+
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+    def stats(self):
+        '''Returns a dict with the cache's size and its hit, miss and eviction counters.
+        '''
+
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,217 @@
+'''Opening book: the moves played from each opening position in a collection of games, so the engine can
+answer them straight away instead of searching. The book is a file of 16-byte entries laid out like
+Polyglot's (position key, move, weight, learn; big-endian), sorted by key, and read through mmap
+with a binary search. Positions are keyed by GameState's Zobrist keys rather than Polyglot's,
+so the book only works with this program. Source: http://hgm.nubati.net/book_format.html
+
+Usage:
+    python opening_book.py                              # Builds book.bin from the games in games.db.
+    python opening_book.py --pgn games.pgn --plies 30   # Builds it from a PGN file, 30 plies deep.
+    python opening_book.py --fen "<FEN>"                # Shows the book moves of a position.
+'''
+
+import argparse
+import chess.pgn
+from gamestate import *
+import io
+import mmap
+import os
+import random
+from search import code_to_uci
+import sqlite3
+import struct
+
+
+BOOK_PATH = "book.bin"
+DATABASE = "games.db"
+
+# Moves after this many plies aren't added to the book.
+MAX_PLIES = 20
+
+# Entry layout: position key, move, weight and learn (unused, always 0).
+ENTRY_FORMAT = struct.Struct(">QHHI")
+
+# Promotion pieces in the order of Polyglot's promotion field (0 means no promotion).
+BOOK_PROMOTIONS = ["", "n", "b", "r", "q"]
+
+# What a game's result adds to the weight of each move white and black played in it: 2 for a win,
+# 1 for a draw and 0 for a loss (like Polyglot's 2 * wins + draws).
+RESULT_WEIGHTS = {"1-0": (2, 0), "0-1": (0, 2), "1/2-1/2": (1, 1)}
+
+
+def book_key(gs):
+    '''Returns the key of the position in the book: its Zobrist key, which (as in Polyglot) only counts the
+    en passant square if a capture is possible (see GameState.ep_hash). This way the key doesn't depend on
+    whether the FEN it was read from lists the en passant square.
+    '''
+
+    return gs.zobrist_key
+
+
+def encode_move(uci):
+    '''Packs a move in UCI notation like Polyglot does: target file and rank, start file and rank
+    (3 bits each, rank 0 is the first rank) and promotion piece. Castling is stored as the king's
+    move (e1g1), not as Polyglot's king-takes-rook (e1h1).
+    '''
+
+    start_file, start_rank = "abcdefgh".index(uci[0]), int(uci[1]) - 1
+    target_file, target_rank = "abcdefgh".index(uci[2]), int(uci[3]) - 1
+    promotion = BOOK_PROMOTIONS.index(uci[4]) if len(uci) > 4 else 0
+    return target_file | target_rank << 3 | start_file << 6 | start_rank << 9 | promotion << 12
+
+
+def decode_move(move):
+    '''Unpacks a move packed by encode_move into UCI notation.
+    '''
+
+    return ("abcdefgh"[move >> 6 & 7] + str((move >> 9 & 7) + 1) + "abcdefgh"[move & 7] +
+            str((move >> 3 & 7) + 1) + BOOK_PROMOTIONS[move >> 12 & 7])
+
+
+class OpeningBook():
+    '''A book file, memory-mapped. Looking up a position is a binary search over the sorted entries.
+    '''
+
+    def __init__(self, path=BOOK_PATH):
+        '''Raises OSError if the book can't be opened.
+        '''
+
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.entries = size // ENTRY_FORMAT.size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+
+    def entry(self, index):
+        '''Returns the entry at index as (key, move, weight, learn).
+        '''
+
+        return ENTRY_FORMAT.unpack_from(self.data, index * ENTRY_FORMAT.size)
+
+
+    def moves(self, fen):
+        '''Returns a list of (move in UCI notation, weight) for the position in fen.
+        '''
+
+        gs = GameState()
+        gs.load_fen(fen)
+        key = book_key(gs)
+
+        # Finds the first entry with this key.
+        low, high = 0, self.entries
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        moves = []
+        while low < self.entries:
+            entry_key, move, weight, _ = self.entry(low)
+            if entry_key != key:
+                break
+            moves.append((decode_move(move), weight))
+            low += 1
+        return moves
+
+
+    def choose_move(self, fen):
+        '''Picks one of the position's book moves at random, each with a chance proportional to its weight.
+        Returns None if the position isn't in the book (or all its moves have weight 0).
+        '''
+
+        moves = [(move, weight) for move, weight in self.moves(fen) if weight > 0]
+        if not moves:
+            return None
+        return random.choices([move for move, _ in moves], weights=[weight for _, weight in moves])[0]
+
+
+    def close(self):
+        '''Closes the book file.
+        '''
+
+        if self.entries:
+            self.data.close()
+        self.file.close()
+
+
+def read_games(text):
+    '''Yields the games in a PGN string (which can hold any number of games).
+    '''
+
+    pgn = io.StringIO(text)
+    while True:
+        game = chess.pgn.read_game(pgn)
+        if game is None:
+            return
+        yield game
+
+
+def build_book(games, path=BOOK_PATH, max_plies=MAX_PLIES):
+    '''Writes a book with the moves of the first max_plies plies of the games (python-chess games)
+    and returns the number of entries.
+    '''
+
+    weights = {}
+    for game in games:
+        winner_weight = RESULT_WEIGHTS.get(game.headers.get("Result"), (1, 1))
+        gs = GameState()
+        for ply, move in enumerate(game.mainline_moves()):
+            if ply >= max_plies:
+                break
+
+            # Plays the move on our own board, so the key is the same one GameState gives the position.
+            codes = {code_to_uci(code): code for code in gs.legal_moves()}
+            uci = move.uci()
+            if uci not in codes:
+                break
+            entry = (book_key(gs), encode_move(uci))
+            weights[entry] = weights.get(entry, 0) + winner_weight[0 if gs.w_to_move else 1]
+            gs.make_move(codes[uci])
+
+    # Entries are sorted by key, and each position's moves by weight, highest first. Weights have to fit in 16 bits.
+    entries = sorted(weights.items(), key=lambda item: (item[0][0], -item[1]))
+    with open(path, "wb") as f:
+        for (key, move), weight in entries:
+            f.write(ENTRY_FORMAT.pack(key, move, min(weight, 0xFFFF), 0))
+    return len(entries)
+
+
+def database_games(database=DATABASE):
+    '''Yields the games stored in the games table.
+    '''
+
+    db = sqlite3.connect(database)
+    for (pgn,) in db.execute("SELECT pgn FROM games ORDER BY id").fetchall():
+        yield from read_games(pgn)
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the opening book, or shows the book moves of a position.")
+    parser.add_argument("--pgn", help="PGN file to build the book from (instead of games.db)")
+    parser.add_argument("--database", default=DATABASE, help="SQLite database with the games table")
+    parser.add_argument("--plies", type=int, default=MAX_PLIES, help="number of plies of each game to add")
+    parser.add_argument("--book", default=BOOK_PATH, help="book file")
+    parser.add_argument("--fen", help="show the book moves of this position instead of building the book")
+    args = parser.parse_args()
+
+    if args.fen:
+        book = OpeningBook(args.book)
+        for move, weight in book.moves(args.fen):
+            print(move + ": " + str(weight))
+        book.close()
+        return
+
+    if args.pgn:
+        with open(args.pgn) as f:
+            games = list(read_games(f.read()))
+    else:
+        games = list(database_games(args.database))
+    entries = build_book(games, args.book, args.plies)
+    print(str(entries) + " entries from " + str(len(games)) + " games written to " + args.book)
+
+
+if __name__ == "__main__":
+    main()
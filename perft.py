@@ -0,0 +1,191 @@
+'''Counts the leaf nodes of the move generation tree (perft) to check and benchmark GameState.
+Source: https://www.chessprogramming.org/Perft_Results
+
+Usage:
+    python perft.py 4                          # Start position, depth 4.
+    python perft.py 3 --fen "<FEN>" --divide   # Nodes under each root move.
+    python perft.py --suite 3                  # Checks the reference positions up to depth 3.
+    python perft.py 5 --workers 8 --split 2    # Splits the depth 2 subtrees across 8 processes.
+'''
+
+import argparse
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from gamestate import *
+from search import code_to_uci
+
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# Reference positions and their known node counts for each depth.
+REFERENCE_POSITIONS = [
+    ("Start position", START_FEN,
+     {1: 20, 2: 400, 3: 8902, 4: 197281, 5: 4865609}),
+    ("Kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     {1: 48, 2: 2039, 3: 97862, 4: 4085603}),
+    ("Position 3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     {1: 14, 2: 191, 3: 2812, 4: 43238, 5: 674624}),
+    ("Position 4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     {1: 6, 2: 264, 3: 9467, 4: 422333}),
+    ("Position 5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     {1: 44, 2: 1486, 3: 62379, 4: 2103487}),
+    ("Position 6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     {1: 46, 2: 2079, 3: 89890, 4: 3894594}),
+]
+
+
+def perft(gs, depth):
+    '''Returns the number of positions reached after playing every sequence
+    of depth valid moves from the current position.
+    '''
+
+    if depth == 0:
+        return 1
+    moves = gs.legal_moves()
+
+    # The leaves don't need to be played: counting them is enough.
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        gs.make_move(move)
+        nodes += perft(gs, depth - 1)
+        gs.undo_move()
+    return nodes
+
+
+def divide(gs, depth):
+    '''Returns a dict with the number of nodes under each root move, which
+    makes it easy to find the move a buggy count comes from.
+    '''
+
+    results = {}
+    for move in gs.get_valid_moves():
+        gs.make_move(move)
+        results[uci(move)] = perft(gs, depth - 1)
+        gs.undo_move()
+    return results
+
+
+def split_moves(gs, split_depth, prefix=()):
+    '''Returns every sequence of split_depth valid moves from the position, as tuples of packed
+    move codes, along with a snapshot of the position each one leads to. Each of these
+    positions is the root of a subtree a worker can count on its own.
+    '''
+
+    if len(prefix) == split_depth:
+        return [(prefix, gs.snapshot())]
+    sequences = []
+    for code in gs.legal_moves():
+        gs.make_move(code)
+        sequences += split_moves(gs, split_depth, prefix + (code,))
+        gs.undo_move()
+    return sequences
+
+
+def count_subtree(task):
+    '''Runs in a worker process. The task is a (move codes, snapshot, depth) tuple: the worker sets up
+    the position from the snapshot and counts the nodes depth moves below it.
+    Returns the move codes, the node count and how long the count took.
+    '''
+
+    codes, record, depth = task
+    gs = GameState.from_snapshot(record)
+    start = time.perf_counter()
+    nodes = perft(gs, depth)
+    return codes, nodes, time.perf_counter() - start
+
+
+def parallel_perft(fen, depth, workers=None, split_depth=1):
+    '''Counts the nodes like perft, splitting the subtrees split_depth moves below the root across
+    worker processes (workers=None uses one per CPU). Workers only receive a snapshot of the
+    position at the root of their subtree (see GameState.snapshot), not a GameState. Returns the node count and a list
+    of (moves in UCI notation, nodes, seconds) for every subtree.
+    '''
+
+    split_depth = min(split_depth, depth)
+    gs = GameState()
+    gs.load_fen(fen)
+    tasks = [(codes, record, depth - split_depth) for codes, record in split_moves(gs, split_depth)]
+
+    subtrees = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for codes, nodes, elapsed in pool.map(count_subtree, tasks):
+            subtrees.append((" ".join(code_to_uci(code) for code in codes), nodes, elapsed))
+    return sum(nodes for _, nodes, _ in subtrees), subtrees
+
+
+def uci(move):
+    '''Returns the move in UCI notation (e. g. e2e4, or e7e8n for a promotion).
+    '''
+
+    notation = move.chess_notation()
+    if move.is_pawn_promotion:
+        notation += move.promotion.lower()
+    return notation
+
+
+def run(fen, depth, show_divide=False, workers=None, split_depth=1):
+    '''Runs perft on a FEN and prints the node count and the nodes per second.
+    If workers is given, the count runs in that many processes (see parallel_perft),
+    and show_divide prints every subtree with its timing. Returns the node count.
+    '''
+
+    gs = GameState()
+    gs.load_fen(fen)
+    start = time.perf_counter()
+    if workers:
+        nodes, subtrees = parallel_perft(fen, depth, workers, split_depth)
+        if show_divide:
+            for moves, subtree_nodes, elapsed in sorted(subtrees):
+                print(moves + ": " + str(subtree_nodes) + " (" + "%.3f" % elapsed + "s)")
+    elif show_divide:
+        results = divide(gs, depth)
+        for move in sorted(results):
+            print(move + ": " + str(results[move]))
+        nodes = sum(results.values())
+    else:
+        nodes = perft(gs, depth)
+    elapsed = time.perf_counter() - start
+    print("Depth " + str(depth) + ": " + str(nodes) + " nodes in " + "%.3f" % elapsed + "s (" +
+          str(int(nodes / elapsed) if elapsed > 0 else 0) + " nodes/s)")
+    return nodes
+
+
+def run_suite(max_depth, workers=None, split_depth=1):
+    '''Checks every reference position up to max_depth. Returns True if all counts match.
+    '''
+
+    passed = True
+    for name, fen, counts in REFERENCE_POSITIONS:
+        print(name + " (" + fen + ")")
+        for depth in sorted(counts):
+            if depth > max_depth:
+                break
+            nodes = run(fen, depth, workers=workers, split_depth=split_depth)
+            if nodes != counts[depth]:
+                print("    expected " + str(counts[depth]))
+                passed = False
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Counts the leaf nodes of the move generation tree.")
+    parser.add_argument("depth", type=int, nargs="?", default=3)
+    parser.add_argument("--fen", default=START_FEN, help="position to start from")
+    parser.add_argument("--divide", action="store_true", help="show the node count under each root move")
+    parser.add_argument("--suite", type=int, metavar="MAX_DEPTH",
+                        help="check the reference positions up to MAX_DEPTH")
+    parser.add_argument("--workers", type=int, help="number of worker processes to count with")
+    parser.add_argument("--split", type=int, default=1, choices=[1, 2],
+                        help="depth of the subtrees handed to the workers")
+    args = parser.parse_args()
+
+    if args.suite:
+        sys.exit(0 if run_suite(args.suite, args.workers, args.split) else 1)
+    run(args.fen, args.depth, args.divide, args.workers, args.split)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+'''Built-in chess engine: an iterative deepening alpha-beta search over GameState, for when
+Stockfish isn't available. Its results have the same format as engine.analyze_position's.
+Sources: https://www.chessprogramming.org/Alpha-Beta, https://www.chessprogramming.org/Transposition_Table,
+https://www.chessprogramming.org/Quiescence_Search and https://www.chessprogramming.org/Move_Ordering
+
+Usage:
+    python search.py --time 5                   # Searches the start position for 5 seconds.
+    python search.py --fen "<FEN>" --depth 4    # Searches a position to depth 4.
+'''
+
+import argparse
+import threading
+import time
+from gamestate import *
+
+
+# Scores. A mate found at ply n scores MATE - n, so quicker mates score higher;
+# anything above MATE_BOUND is a mate.
+MATE = 100000
+MATE_BOUND = MATE - 1000
+INFINITY = MATE + 1
+
+# Depth searched when no depth, time or node limit is given.
+DEFAULT_DEPTH = 4
+MAX_DEPTH = 64
+
+# Kinds of scores stored in the transposition table: exact, or a lower
+# (the search failed high) or upper (it failed low) bound.
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# Move ordering scores: the transposition table move first, then captures by MVV-LVA
+# (most valuable victim, least valuable attacker), then killers, then quiet moves by history.
+TT_MOVE_SCORE = 1 << 30
+CAPTURE_SCORE = 1 << 28
+KILLER_SCORE = 1 << 27
+
+
+class SearchStopped(Exception):
+    '''Raised inside the search when it hits its time or node limit.
+    '''
+
+
+class Searcher():
+    '''Searches positions with iterative deepening alpha-beta. The transposition table is kept
+    between searches, so analysing the next position of a game reuses what was already found.
+    '''
+
+    def __init__(self, tt_size=1 << 20):
+        '''tt_size is the number of positions the transposition table holds before it is cleared.
+        '''
+
+        # Transposition table: Zobrist key -> (depth, score, kind, best move code).
+        self.tt = {}
+        self.tt_size = tt_size
+
+        # History heuristic, indexed by a quiet move's start and target squares (start * 64 + target),
+        # and two killer moves (quiet moves that caused a cutoff) per ply.
+        self.history = [0] * 4096
+        self.killers = [[0, 0] for _ in range(MAX_DEPTH + 32)]
+
+        # Limits and counters of the current search, and the statistics of the last one.
+        self.nodes = 0
+        self.node_limit = None
+        self.deadline = None
+        self.can_stop = False
+        self.stop_requested = threading.Event()
+        self.stats = {"depth": 0, "nodes": 0, "time": 0.0, "nps": 0}
+
+
+    def search(self, gs, num_moves_to_return=1, depth_limit=None, time_limit=None, node_limit=None):
+        '''Searches the position and returns a list of (score, pv) for the best num_moves_to_return moves,
+        best first. Scores are in centipawns from the point of view of the player to move,
+        and pv is a list of packed move codes. The position is left as it was.
+        '''
+
+        if depth_limit is None and time_limit is None and node_limit is None:
+            depth_limit = DEFAULT_DEPTH
+        self.stop_requested.clear()
+        results = []
+        for _, results in self.iterate(gs, num_moves_to_return, depth_limit, time_limit, node_limit):
+            pass
+        return results
+
+
+    def iterate(self, gs, num_moves_to_return=1, depth_limit=None, time_limit=None, node_limit=None):
+        '''Same as search, but yields (depth, results) after each completed iteration, so the caller can
+        show the best lines as they improve. Without limits it runs up to MAX_DEPTH or until stop is called.
+        searcher.stats is updated after every iteration.
+        '''
+
+        start = time.perf_counter()
+        self.deadline = start + time_limit if time_limit is not None else None
+        self.node_limit = node_limit
+        self.nodes = 0
+        self.history = [0] * 4096
+        self.killers = [[0, 0] for _ in range(MAX_DEPTH + 32)]
+        self.stats = {"depth": 0, "nodes": 0, "time": 0.0, "nps": 0}
+
+        # Positions already played since the last capture or pawn move count as
+        # repetitions (draws) if the search reaches them again.
+        # (The clock can be higher than the number of moves played, if the game was set up from a FEN.)
+        self.seen = {entry[4] for entry in gs.undo_log[max(0, len(gs.undo_log) - gs.halfmove_clock):]}
+
+        root_moves = gs.legal_moves()
+        if not root_moves:
+            return
+        game_length = len(gs.move_log)
+        scores = {code: 0 for code in root_moves}
+        for depth in range(1, min(depth_limit or MAX_DEPTH, MAX_DEPTH) + 1):
+
+            # The first iteration always completes (unless stop is called), so there is always a move to return.
+            self.can_stop = depth > 1
+            try:
+                results = self.search_root(gs, root_moves, scores, depth, num_moves_to_return)
+            except SearchStopped:
+
+                # Takes back the moves the interrupted search was in the middle of.
+                while len(gs.move_log) > game_length:
+                    gs.undo_move()
+                return
+            root_moves.sort(key=lambda code: scores[code], reverse=True)
+
+            elapsed = time.perf_counter() - start
+            self.stats = {"depth": depth, "nodes": self.nodes, "time": elapsed,
+                          "nps": int(self.nodes / elapsed) if elapsed > 0 else 0}
+            yield depth, results
+
+            # No need to look deeper once the best move is a forced mate.
+            if abs(results[0][0]) > MATE_BOUND:
+                return
+
+
+    def search_root(self, gs, root_moves, scores, depth, num_moves_to_return):
+        '''Searches every root move to the given depth. The best num_moves_to_return moves get
+        exact scores: each move is searched with alpha set to the worst score among them so far.
+        '''
+
+        results = []
+        for code in root_moves:
+            if len(results) >= num_moves_to_return:
+                alpha = results[num_moves_to_return - 1][0]
+            else:
+                alpha = -INFINITY
+            pv = []
+            gs.make_move(code)
+            score = -self.negamax(gs, depth - 1, -INFINITY, -alpha, 1, pv)
+            gs.undo_move()
+            scores[code] = score
+            if score > alpha:
+                results.append((score, [code] + pv))
+                results.sort(key=lambda result: result[0], reverse=True)
+
+            self.check_limits()
+        return results[:num_moves_to_return]
+
+
+    def negamax(self, gs, depth, alpha, beta, ply, pv):
+        '''Returns the score of the position for the player to move, filling pv with the best line.
+        '''
+
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.check_limits()
+        key = gs.zobrist_key
+        if key in self.seen or gs.is_fifty_move_draw():
+            return 0
+
+        # Uses the stored score if it was searched at least as deep and its bound settles the window.
+        entry = self.tt.get(key)
+        tt_move = 0
+        if entry is not None:
+            tt_depth, tt_score, kind, tt_move = entry
+            if tt_depth >= depth:
+                tt_score = score_from_tt(tt_score, ply)
+                if kind == EXACT or (kind == LOWER and tt_score >= beta) or (kind == UPPER and tt_score <= alpha):
+                    if tt_move:
+                        pv[:] = [tt_move]
+                    return tt_score
+
+        # Checks are extended, so the horizon doesn't hide a mate.
+        in_check = gs.in_check()
+        if in_check:
+            depth += 1
+        if depth <= 0:
+            return self.quiescence(gs, alpha, beta, ply)
+
+        moves = gs.legal_moves()
+        if not moves:
+            return -MATE + ply if in_check else 0
+        self.order_moves(gs, moves, tt_move, ply)
+
+        alpha_start = alpha
+        best_score = -INFINITY
+        best_move = 0
+        self.seen.add(key)
+        try:
+            for code in moves:
+                child_pv = []
+                gs.make_move(code)
+                score = -self.negamax(gs, depth - 1, -beta, -alpha, ply + 1, child_pv)
+                gs.undo_move()
+                if score > best_score:
+                    best_score = score
+                    best_move = code
+                    if score > alpha:
+                        alpha = score
+                        pv[:] = [code] + child_pv
+                        if score >= beta:
+
+                            # Quiet moves that cause a cutoff are tried early in sibling positions.
+                            if self.is_quiet(gs, code):
+                                killers = self.killers[ply]
+                                if killers[0] != code:
+                                    killers[1] = killers[0]
+                                    killers[0] = code
+                                self.history[code & 4095] += depth * depth
+                            break
+        finally:
+            self.seen.discard(key)
+
+        if best_score >= beta:
+            kind = LOWER
+        elif best_score > alpha_start:
+            kind = EXACT
+        else:
+            kind = UPPER
+        if len(self.tt) >= self.tt_size:
+            self.tt.clear()
+        self.tt[key] = (depth, score_to_tt(best_score, ply), kind, best_move)
+        return best_score
+
+
+    def quiescence(self, gs, alpha, beta, ply):
+        '''Searches captures (and promotions) until the position is quiet, so the
+        evaluation isn't taken in the middle of an exchange. In check, every evasion is searched.
+        '''
+
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.check_limits()
+
+        if gs.in_check():
+            moves = gs.legal_moves()
+            if not moves:
+                return -MATE + ply
+            best_score = -INFINITY
+        else:
+
+            # Stand pat: the player to move can usually do at least as well as the static evaluation.
+            best_score = gs.score() if gs.w_to_move else -gs.score()
+            if best_score >= beta:
+                return best_score
+            alpha = max(alpha, best_score)
+            moves = gs.legal_captures()
+        self.order_moves(gs, moves, 0, ply)
+
+        for code in moves:
+            gs.make_move(code)
+            score = -self.quiescence(gs, -beta, -alpha, ply + 1)
+            gs.undo_move()
+            if score > best_score:
+                best_score = score
+                if score > alpha:
+                    alpha = score
+                    if score >= beta:
+                        break
+        return best_score
+
+
+    def order_moves(self, gs, moves, tt_move, ply):
+        '''Sorts the moves so the ones most likely to be best are searched first.
+        '''
+
+        board = gs.board
+        killers = self.killers[ply]
+        history = self.history
+
+        def move_score(code):
+            if code == tt_move:
+                return TT_MOVE_SCORE
+            target = code >> 6 & 63
+            victim = board[target >> 3][target & 7]
+            flag = code >> 12
+            if victim != "--" or flag == FLAG_EP or flag >= FLAG_PROMOTION:
+                start = code & 63
+                attacker = board[start >> 3][start & 7]
+                gain = PIECE_VALUES[victim[1]] if victim != "--" else PIECE_VALUES["P"] * (flag == FLAG_EP)
+                if flag >= FLAG_PROMOTION:
+                    gain += PIECE_VALUES[PROMOTION_PIECES[flag - FLAG_PROMOTION]]
+                return CAPTURE_SCORE + gain * 16 - PIECE_VALUES[attacker[1]] // 100
+            if code == killers[0] or code == killers[1]:
+                return KILLER_SCORE + (code == killers[0])
+            return history[code & 4095]
+
+        moves.sort(key=move_score, reverse=True)
+
+
+    def is_quiet(self, gs, code):
+        '''Returns True if the move (already taken back) isn't a capture or a promotion.
+        '''
+
+        target = code >> 6 & 63
+        flag = code >> 12
+        return gs.board[target >> 3][target & 7] == "--" and flag != FLAG_EP and flag < FLAG_PROMOTION
+
+
+    def stop(self):
+        '''Asks a search running on another thread to stop as soon as possible. If it is stopped
+        before the first iteration completes, it returns no moves.
+        '''
+
+        self.stop_requested.set()
+
+
+    def check_limits(self):
+        '''Stops the search if another thread called stop, or if it ran out of time or nodes.
+        '''
+
+        if self.stop_requested.is_set():
+            raise SearchStopped()
+        if not self.can_stop:
+            return
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchStopped()
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            raise SearchStopped()
+
+
+def score_to_tt(score, ply):
+    '''Mate scores are stored relative to the position rather than the root.
+    '''
+
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+
+def code_to_uci(code):
+    '''Returns a packed move code in UCI notation (e. g. e2e4, or e7e8n for a promotion).
+    '''
+
+    start = code & 63
+    target = code >> 6 & 63
+    flag = code >> 12
+    notation = (cols_to_files[start & 7] + rows_to_ranks[start >> 3] +
+                cols_to_files[target & 7] + rows_to_ranks[target >> 3])
+    if flag >= FLAG_PROMOTION:
+        notation += PROMOTION_PIECES[flag - FLAG_PROMOTION].lower()
+    return notation
+
+
+def format_result(score, pv, w_to_move):
+    '''Converts a search result to the dict engine.format_info returns: mate_score (in moves) or
+    centipawn_score, both positive for white and negative for black, and the pv in UCI notation.
+    '''
+
+    mate_score = None
+    centipawn_score = None
+    if score > MATE_BOUND:
+        mate_score = (MATE - score + 1) // 2
+    elif score < -MATE_BOUND:
+        mate_score = -((MATE + score) // 2)
+    else:
+        centipawn_score = score
+    if not w_to_move:
+        mate_score = -mate_score if mate_score is not None else None
+        centipawn_score = -centipawn_score if centipawn_score is not None else None
+    return {
+        "mate_score": mate_score,
+        "centipawn_score": centipawn_score,
+        "pv": [code_to_uci(code) for code in pv],
+    }
+
+
+# Shared searcher, so the transposition table carries over from one move to the next.
+searcher = Searcher()
+
+
+def analyze_position(fen, num_moves_to_return=1, depth_limit=None, time_limit=None, node_limit=None):
+    '''Same as engine.analyze_position, but searched by the built-in engine. The nodes
+    searched and the nodes per second of the search are in searcher.stats.
+    '''
+
+    gs = GameState()
+    gs.load_fen(fen)
+    results = searcher.search(gs, num_moves_to_return, depth_limit, time_limit, node_limit)
+    return [format_result(score, pv, gs.w_to_move) for score, pv in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Searches a position with the built-in engine.")
+    parser.add_argument("--fen", default="rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1")
+    parser.add_argument("--depth", type=int, help="maximum depth")
+    parser.add_argument("--time", type=float, help="time limit in seconds")
+    parser.add_argument("--nodes", type=int, help="node limit")
+    parser.add_argument("--multipv", type=int, default=1, help="number of lines to show")
+    args = parser.parse_args()
+
+    for info in analyze_position(args.fen, args.multipv, args.depth, args.time, args.nodes):
+        print(info)
+    stats = searcher.stats
+    print("Depth " + str(stats["depth"]) + ": " + str(stats["nodes"]) + " nodes in " + "%.3f" % stats["time"] +
+          "s (" + str(stats["nps"]) + " nodes/s)")
+
+
+if __name__ == "__main__":
+    main()
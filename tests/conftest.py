@@ -0,0 +1,7 @@
+'''Lets the tests import the modules in the repository's root (gamestate, engine, ...).
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,47 @@
+'''A small stand-in for Stockfish, so the engine pool can be tested without it. It speaks just enough UCI
+for python-chess: it reports two options, answers pings, and on "go" gives one line of analysis
+(depth 5, +0.12) and plays the first legal move of the position (found with python-chess).
+
+Usage:
+    EnginePool(command=[sys.executable, "tests/fake_uci.py"])
+'''
+
+import chess
+import sys
+
+
+def main():
+    board = chess.Board()
+    for line in sys.stdin:
+        words = line.split()
+        if not words:
+            continue
+        command = words[0]
+
+        if command == "uci":
+            print("id name Fake UCI")
+            print("option name Threads type spin default 1 min 1 max 8")
+            print("option name Hash type spin default 16 min 1 max 64")
+            print("uciok")
+        elif command == "isready":
+            print("readyok")
+        elif command == "position":
+            # position startpos|fen <FEN> [moves <move> ...]
+            moves = words.index("moves") if "moves" in words else len(words)
+            board = chess.Board() if words[1] == "startpos" else chess.Board(" ".join(words[2:moves]))
+            for move in words[moves + 1:]:
+                board.push_uci(move)
+        elif command == "go":
+            move = next(iter(board.legal_moves), None)
+            if move is None:
+                print("bestmove (none)")
+            else:
+                print("info depth 5 multipv 1 score cp 12 nodes 100 nps 1000 pv " + move.uci())
+                print("bestmove " + move.uci())
+        elif command == "quit":
+            break
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
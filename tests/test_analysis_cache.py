@@ -0,0 +1,53 @@
+'''Tests for the cache of engine analyses (analysis_cache.py).
+'''
+
+from analysis_cache import AnalysisCache
+import os
+
+
+START = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+LINES = [{"mate_score": None, "centipawn_score": 30, "pv": ["e2e4", "e7e5"]},
+         {"mate_score": None, "centipawn_score": 25, "pv": ["d2d4", "d7d5"]}]
+
+
+def test_covers():
+    cache = AnalysisCache(path=None)
+
+    # (multipv, depth_limit, time_limit, depth reached, lines)
+    entry = (2, 10, None, 10, LINES)
+    assert cache.covers(entry, 1, 10, None)
+    assert cache.covers(entry, 2, 8, None)
+    assert not cache.covers(entry, 3, 8, None)
+    assert not cache.covers(entry, 1, 12, None)
+
+    # A search stopped by its time limit answers requests with less time, or one that reached the depth asked for.
+    timed = (1, None, 2.0, 14, LINES[:1])
+    assert cache.covers(timed, 1, None, 1.0)
+    assert not cache.covers(timed, 1, None, 5.0)
+    assert cache.covers(timed, 1, 12, 5.0)
+
+
+def test_lookups_are_keyed_by_engine():
+    cache = AnalysisCache(path=None)
+    cache.put("builtin", START, 2, 10, None, 10, LINES)
+    assert cache.get("builtin", START, 1, 10) == LINES[:1]
+    assert cache.get("Stockfish 16", START, 1, 10) is None
+
+    # The move counters don't matter.
+    assert cache.get("builtin", START.replace(" 0 1", " 4 9"), 2, 10) == LINES
+    assert (cache.requests, cache.memory_hits) == (3, 2)
+
+
+def test_database_keeps_analyses(tmp_path):
+    path = str(tmp_path / "analysis.db")
+    cache = AnalysisCache(path)
+    assert not os.path.exists(path)
+    cache.put("builtin", START, 2, 10, None, 10, LINES)
+    cache.close()
+
+    # A new cache (the next time the program runs) finds it in the database, for the same engine only.
+    cache = AnalysisCache(path)
+    assert cache.get("builtin", START, 2, 8) == LINES
+    assert cache.get("Stockfish 16", START, 2, 8) is None
+    assert cache.database_hits == 1
+    cache.close()
@@ -0,0 +1,65 @@
+'''Checks the vectorised counts of batch_movegen.py against GameState's own move generator, on the perft
+reference positions and on positions from random games played from them.
+'''
+
+from batch_movegen import *
+from gamestate import *
+import numpy as np
+from perft import REFERENCE_POSITIONS
+import random
+
+
+# Random games played from each reference position, and their maximum length in plies.
+GAMES = 20
+PLIES = 60
+
+
+def expected(gs):
+    '''Returns what GameState finds in its position: the number of legal and pseudo-legal moves,
+    whether the side to move is in check, and the squares attacked by white and by black.
+    '''
+
+    return (len(gs.legal_moves()), len(gs.possible_moves()), gs.in_check(), gs.attack_map("w"), gs.attack_map("b"))
+
+
+def results(batch):
+    '''Returns the same values as expected, for every position of the batch, from batch_movegen.
+    '''
+
+    white, black = attack_maps(batch)
+    return list(zip(legal_move_counts(batch).tolist(), pseudo_legal_move_counts(batch).tolist(),
+                    in_check(batch).tolist(), [int(bb) for bb in white], [int(bb) for bb in black]))
+
+
+def test_reference_positions():
+    states = []
+    for _, fen, _ in REFERENCE_POSITIONS:
+        gs = GameState()
+        gs.load_fen(fen)
+        states.append(gs)
+
+    batch = PositionBatch.from_fens([fen for _, fen, _ in REFERENCE_POSITIONS])
+    assert results(batch) == [expected(gs) for gs in states]
+    assert legal_move_counts(batch).tolist() == [len(gs.get_valid_moves()) for gs in states]
+    assert legal_move_counts(batch).tolist() == [counts[1] for _, _, counts in REFERENCE_POSITIONS]
+
+
+def test_random_game_positions():
+    rng = random.Random(2022)
+    batches, positions = [], []
+    for _, fen, _ in REFERENCE_POSITIONS:
+        for _ in range(GAMES):
+            gs = GameState()
+            gs.load_fen(fen)
+            for _ in range(rng.randint(0, PLIES)):
+                # Copies the position before the move is made, since the GameState is reused.
+                batches.append(PositionBatch.from_gamestates([gs]))
+                positions.append(expected(gs))
+                codes = gs.legal_moves()
+                if not codes:
+                    break
+                gs.make_move(rng.choice(codes))
+
+    batch = PositionBatch(np.concatenate([b.pieces for b in batches]), np.concatenate([b.white for b in batches]),
+                          np.concatenate([b.castling for b in batches]), np.concatenate([b.ep for b in batches]))
+    assert results(batch) == positions
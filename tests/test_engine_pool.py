@@ -0,0 +1,77 @@
+'''Tests EnginePool with a fake UCI engine (fake_uci.py), so Stockfish doesn't have to be installed.
+'''
+
+import chess
+import chess.engine
+from engine import EnginePool
+import os
+import pytest
+import queue
+import signal
+import sys
+
+
+FAKE_ENGINE = [sys.executable, os.path.join(os.path.dirname(__file__), "fake_uci.py")]
+LIMIT = chess.engine.Limit(depth=5)
+
+
+@pytest.fixture
+def pool():
+    pool = EnginePool(size=2, command=FAKE_ENGINE)
+    yield pool
+    pool.close(timeout=5)
+
+
+def test_analyse(pool):
+    info = pool.analyse(chess.Board(), LIMIT)
+    assert info["depth"] == 5
+    assert info["score"].white().score() == 12
+    assert info["pv"][0] in chess.Board().legal_moves
+    assert pool.name == "Fake UCI"
+
+
+def test_checkout_and_checkin(pool):
+    first = pool.checkout()
+    second = pool.checkout()
+    assert first is not second
+    assert pool.is_healthy(first) and pool.is_healthy(second)
+
+    # Both engines are checked out, so a third checkout has to wait.
+    with pytest.raises(queue.Empty):
+        pool.checkout(timeout=0.1)
+
+    pool.checkin(first)
+    pool.checkin(second)
+    with pool.engine() as engine:
+        assert engine is second
+    assert pool.restarts == 0
+
+
+def test_dead_engine_is_restarted(pool):
+    engine = pool.checkout()
+    os.kill(engine.transport.get_pid(), signal.SIGKILL)
+    assert not pool.is_healthy(engine)
+    pool.checkin(engine)
+
+    # Checking the dead engine out again (it was checked in last) starts a new process in its place.
+    with pool.engine() as restarted:
+        assert restarted is not engine
+        assert pool.is_healthy(restarted)
+    assert pool.restarts == 1
+
+    # Both engines still analyse.
+    first, second = pool.checkout(), pool.checkout()
+    for engine in (first, second):
+        assert engine.analyse(chess.Board(), LIMIT)["depth"] == 5
+        pool.checkin(engine)
+    assert pool.analyse(chess.Board(), LIMIT)["depth"] == 5
+    assert pool.restarts == 1
+
+
+def test_analyse_after_an_engine_died(pool):
+    with pool.engine() as engine:
+        pass
+    os.kill(engine.transport.get_pid(), signal.SIGKILL)
+    board = chess.Board("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1")
+    assert pool.analyse(board, LIMIT)["pv"][0] in board.legal_moves
+    assert pool.restarts == 1
@@ -0,0 +1,128 @@
+'''Tests for GameState's FEN loading, draw detection, Zobrist keys, evaluation, snapshots and clones.
+'''
+
+from evaluation import evaluate
+from gamestate import *
+from perft import REFERENCE_POSITIONS
+import pytest
+import random
+from search import code_to_uci
+
+
+def play(gs, moves):
+    '''Plays moves given in UCI notation.
+    '''
+
+    for uci in moves:
+        codes = {code_to_uci(code): code for code in gs.legal_moves()}
+        gs.make_move(codes[uci])
+
+
+def test_threefold_repetition_after_double_push():
+    # The position after 1. d4 comes back twice, with no en passant capture possible in any of them.
+    gs = GameState()
+    play(gs, ["d2d4", "g8f6", "g1f3", "f6g8", "f3g1", "g8f6", "g1f3", "f6g8", "f3g1"])
+    assert gs.repetitions() == 2
+    assert gs.is_threefold_repetition()
+
+
+def test_ep_square_only_counts_when_capturable():
+    # Same position with and without the (uncapturable) en passant square in the FEN.
+    with_ep, without_ep = GameState(), GameState()
+    with_ep.load_fen("rnbqkbnr/pppppppp/8/8/3P4/8/PPP1PPPP/RNBQKBNR b KQkq d3 0 1")
+    without_ep.load_fen("rnbqkbnr/pppppppp/8/8/3P4/8/PPP1PPPP/RNBQKBNR b KQkq - 0 1")
+    assert with_ep.zobrist_key == without_ep.zobrist_key
+
+    # A capturable one does count.
+    capturable, not_listed = GameState(), GameState()
+    capturable.load_fen("rnbqkbnr/ppp1pppp/8/8/2pP4/8/PP2PPPP/RNBQKBNR b KQkq d3 0 3")
+    not_listed.load_fen("rnbqkbnr/ppp1pppp/8/8/2pP4/8/PP2PPPP/RNBQKBNR b KQkq - 0 3")
+    assert capturable.zobrist_key != not_listed.zobrist_key
+
+
+def test_incremental_key_matches_key_from_scratch():
+    gs = GameState()
+    play(gs, ["e2e4", "d7d5", "e4e5", "f7f5", "e5f6", "g7f6", "d1h5", "e8d7"])
+    key = gs.zobrist_key
+    gs.reset_zobrist()
+    assert gs.zobrist_key == key
+
+
+@pytest.mark.parametrize("fen", [
+    "rnbqkbnr/ppp w KQkq - 0 1",
+    "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq e9 0 1",
+    "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR x KQkq - 0 1",
+    "8/8/8/8/8/8/8/8 w - - 0 1",
+    "not a fen",
+])
+def test_invalid_fen_leaves_position_unchanged(fen):
+    gs = GameState()
+    play(gs, ["e2e4", "c7c5"])
+    before = (gs.snapshot(), gs.zobrist_key, list(gs.move_log), list(gs.undo_log))
+    with pytest.raises(ValueError):
+        gs.load_fen(fen)
+    assert (gs.snapshot(), gs.zobrist_key, list(gs.move_log), list(gs.undo_log)) == before
+
+
+def test_fen_without_move_counters():
+    gs = GameState()
+    gs.load_fen("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq -")
+    assert gs.fullmove_number == 1 and gs.halfmove_clock == 0
+    gs.load_fen("rnbqkbnr/pp1ppppp/8/2p5/4P3/8/PPPP1PPP/RNBQKBNR w KQkq c6 0 2")
+    assert gs.fullmove_number == 2 and not gs.move_log
+
+
+# Moves that change the castling rights and leave an en passant capture possible at the end.
+SNAPSHOT_MOVES = ["e2e4", "g8f6", "e4e5", "h8g8", "e1e2", "d7d5"]
+
+
+def same_position(gs, other):
+    return (gs.board == other.board and gs.w_to_move == other.w_to_move and gs.castling_rights == other.castling_rights and
+            gs.ep_possible == other.ep_possible and gs.halfmove_clock == other.halfmove_clock and
+            gs.fullmove_number == other.fullmove_number and gs.zobrist_key == other.zobrist_key and
+            gs.score() == other.score() and sorted(gs.legal_moves()) == sorted(other.legal_moves()))
+
+
+def test_snapshot_round_trip():
+    gs = GameState()
+    play(gs, SNAPSHOT_MOVES)
+    record = gs.snapshot()
+    copy = GameState.from_snapshot(record)
+    assert len(record) == SNAPSHOT_FORMAT.size
+    assert copy.snapshot() == record
+    assert same_position(gs, copy)
+    assert copy.move_log == [] and copy.undo_log == []
+
+
+def test_clone_is_independent():
+    gs = GameState()
+    play(gs, SNAPSHOT_MOVES)
+    copy = gs.clone()
+    assert same_position(gs, copy)
+    assert copy.move_log == [] and copy.undo_log == []
+
+    # Moves made on the copy don't change the original.
+    key, board = gs.zobrist_key, [row[:] for row in gs.board]
+    play(copy, ["e5d6", "c7d6"])
+    assert gs.zobrist_key == key and gs.board == board
+    assert copy.fullmove_number == gs.fullmove_number + 1
+
+
+def test_incremental_score_matches_full_evaluation():
+    # Random games from the perft positions, which have castling, en passant and promotions.
+    rng = random.Random(13)
+    for _, fen, _ in REFERENCE_POSITIONS:
+        gs = GameState()
+        gs.load_fen(fen)
+        assert gs.score() == evaluate(gs)
+        for _ in range(40):
+            codes = gs.legal_moves()
+            if not codes:
+                break
+            gs.make_move(rng.choice(codes))
+            assert gs.score() == evaluate(gs)
+
+        # Taking the moves back restores the score too.
+        while gs.move_log:
+            gs.undo_move()
+            assert gs.score() == evaluate(gs)
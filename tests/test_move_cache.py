@@ -0,0 +1,61 @@
+'''Tests for the LRU cache of legal move lists (move_cache.py) and its use by GameState.
+'''
+
+from gamestate import *
+from move_cache import MoveCache
+from test_gamestate import play
+
+
+def test_least_recently_used_is_evicted():
+    cache = MoveCache(max_size=2)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    assert cache.get(1) == "a"
+
+    # 2 is now the least recently used, so it goes first.
+    cache.put(3, "c")
+    assert cache.get(2) is None
+    assert cache.get(1) == "a" and cache.get(3) == "c"
+    assert cache.stats()["evictions"] == 1
+
+    cache.resize(1)
+    assert cache.get(1) is None and cache.get(3) == "c"
+
+
+def test_stats():
+    cache = MoveCache()
+    cache.put(1, "a")
+    cache.get(1)
+    cache.get(2)
+    stats = cache.stats()
+    assert (stats["size"], stats["hits"], stats["misses"], stats["hit_ratio"]) == (1, 1, 1, 0.5)
+    cache.clear()
+    assert cache.stats()["size"] == 0 and cache.stats()["hits"] == 0
+
+
+def test_cached_moves_match_generated_moves():
+    cache = MoveCache()
+    gs = GameState()
+    gs.move_cache = cache
+    play(gs, ["e2e4", "e7e5", "g1f3"])
+    moves = [move.code for move in gs.get_valid_moves()]
+    assert cache.stats()["misses"] == 1
+
+    # The same position reached again is answered from the cache, with the same moves.
+    other = GameState()
+    other.move_cache = cache
+    play(other, ["g1f3", "e7e5", "e2e4"])
+    assert [move.code for move in other.get_valid_moves()] == moves
+    assert cache.stats()["hits"] == 1
+    assert sorted(moves) == sorted(other.legal_moves())
+
+
+def test_checkmate_is_cached():
+    cache = MoveCache()
+    for _ in range(2):
+        gs = GameState()
+        gs.move_cache = cache
+        play(gs, ["f2f3", "e7e5", "g2g4", "d8h4"])
+        assert gs.get_valid_moves() == []
+        assert gs.checkmate and not gs.stalemate
+    assert cache.stats()["hits"] == 1
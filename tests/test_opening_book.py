@@ -0,0 +1,60 @@
+'''Tests for the opening book (opening_book.py): move encoding, and building a book and reading it back.
+'''
+
+from opening_book import *
+import pytest
+
+
+GAMES = """[Result "1-0"]
+
+1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 1-0
+
+[Result "0-1"]
+
+1. e4 c5 2. Nf3 d6 0-1
+
+[Result "1/2-1/2"]
+
+1. d4 d5 2. c4 e6 1/2-1/2
+"""
+
+START = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+
+@pytest.mark.parametrize("uci", ["e2e4", "g8f6", "e1g1", "a7a8q", "h2h1n", "b7c8r"])
+def test_encode_decode_round_trip(uci):
+    assert decode_move(encode_move(uci)) == uci
+
+
+@pytest.fixture
+def book(tmp_path):
+    path = str(tmp_path / "book.bin")
+    assert build_book(read_games(GAMES), path, max_plies=4) == 11
+    book = OpeningBook(path)
+    yield book
+    book.close()
+
+
+def test_moves_and_weights(book):
+    # e4 won one game and lost one (2 + 0), d4 was a draw (1).
+    assert book.moves(START) == [("e2e4", 2), ("d2d4", 1)]
+
+    # After 1. e4 black played e5 (lost, 0) and c5 (won, 2).
+    after_e4 = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"
+    assert book.moves(after_e4) == [("c7c5", 2), ("e7e5", 0)]
+    assert book.choose_move(after_e4) == "c7c5"
+
+    # The en passant square in the FEN doesn't change the key, and positions past max_plies aren't there.
+    assert book.moves(after_e4.replace(" e3 ", " - ")) == book.moves(after_e4)
+    assert book.moves("r1bqkbnr/pppp1ppp/2n5/1B2p3/4P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 3 3") == []
+
+
+def test_every_entry_is_found(book):
+    # Entries are sorted by key, and every move of the games is found by the binary search.
+    for index in range(1, book.entries):
+        assert book.entry(index - 1)[0] <= book.entry(index)[0]
+    for game in read_games(GAMES):
+        board = game.board()
+        for move in list(game.mainline_moves())[:4]:
+            assert move.uci() in [uci for uci, _ in book.moves(board.fen())]
+            board.push(move)
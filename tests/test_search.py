@@ -0,0 +1,57 @@
+'''Tests for the built-in engine (search.py).
+'''
+
+from gamestate import *
+from search import *
+from test_gamestate import play
+
+
+def test_repetitions_after_loading_a_fen_with_a_halfmove_clock():
+    # The clock (6 after the moves) is higher than the number of moves played (4),
+    # but every position played still counts as a repetition.
+    gs = GameState()
+    gs.load_fen("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 2 2")
+    play(gs, ["g1f3", "g8f6", "f3g1", "f6g8"])
+    searcher = Searcher()
+    searcher.search(gs, depth_limit=1)
+    assert {entry[4] for entry in gs.undo_log} <= searcher.seen
+
+
+def test_mate_in_one():
+    gs = GameState()
+    gs.load_fen("6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1")
+    score, pv = Searcher().search(gs, depth_limit=3)[0]
+    assert code_to_uci(pv[0]) == "a1a8"
+    assert score == MATE - 1
+
+
+def test_transposition_table_is_reused():
+    # Searching the same position again finds the same move with far fewer nodes, from the table.
+    gs = GameState()
+    gs.load_fen("r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3")
+    searcher = Searcher()
+    first = searcher.search(gs, depth_limit=4)
+    first_nodes = searcher.stats["nodes"]
+    assert searcher.tt
+    second = searcher.search(gs, depth_limit=4)
+    assert second[0][1][0] == first[0][1][0]
+    assert searcher.stats["nodes"] < first_nodes // 4
+
+
+def scores_by_move(gs, depth):
+    '''Returns the score of every root move, by its UCI notation.
+    '''
+
+    return {code_to_uci(pv[0]): score for score, pv in Searcher().search(gs, len(gs.legal_moves()), depth_limit=depth)}
+
+
+def test_repetition_scores_as_a_draw():
+    # Playing Ng1 again repeats a position, which the search scores as a draw...
+    gs = GameState()
+    play(gs, ["g1f3", "g8f6", "f3g1", "f6g8", "g1f3", "g8f6"])
+    assert scores_by_move(gs, 1)["f3g1"] == 0
+
+    # ...but not the first time the position comes up.
+    gs = GameState()
+    play(gs, ["g1f3", "g8f6"])
+    assert scores_by_move(gs, 1)["f3g1"] != 0